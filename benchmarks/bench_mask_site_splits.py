@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "qc"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spectrumSplits"))
+from synthetic_tree import generate_tree, use_stand_in
+use_stand_in()
+from flat_tree import FlatTree
+from tree_cache import load_flat_tree
+from mask_site_splits import get_mutation_counts, write_generation, start_pool, scan_positions
+
+# Command-line argument parsing
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measure how the mask_site_splits site scan scales with the number of worker processes.")
+    parser.add_argument("--input_tree", type=str, default="public-latest.all.masked.pb.gz", help="Input tree file (protobuf format)")
+    parser.add_argument("--tree_cache", type=str, nargs="?", const="", default=None, help="Load the tree through the on-disk tree cache")
+    parser.add_argument("--ntips", type=int, default=0, help="Instead of reading a tree, build a synthetic one with this many tips and two planted artifact sites")
+    parser.add_argument("--npositions", type=int, default=2000, help="Genome length of the synthetic tree; a short one makes recurrent sites to scan")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic tree")
+    parser.add_argument("--min_total", type=int, default=500, help="Minimum mutation count to accept a split")
+    parser.add_argument("--min_count", type=int, default=50, help="Minimum number of occurrences for a site to be scanned")
+    parser.add_argument("--nthreads", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="Worker counts to time")
+    parser.add_argument("--repeats", type=int, default=3, help="Scans per worker count; the fastest is reported")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.ntips > 0:
+        flat_tree = FlatTree.from_bte(generate_tree(args.ntips, npositions=args.npositions, nartifacts=2, seed=args.seed))
+    else:
+        flat_tree = load_flat_tree(args.input_tree, args.tree_cache)
+    mutation_counts = get_mutation_counts(flat_tree)
+    total_mutations = sum(mutation_counts.values())
+    positions = sorted((position for position, count in mutation_counts.items() if count >= args.min_count), key=lambda position: -mutation_counts[position])
+    print(f"{len(flat_tree)} nodes, {len(positions)} sites with at least {args.min_count} occurrences", file=sys.stderr)
+
+    state_dir = tempfile.mkdtemp(prefix="bench_mask_site_splits.")
+    write_generation(flat_tree, state_dir, 1)
+    print("nthreads\tseconds\tsites_per_second\tspeedup")
+    baseline = None
+    for nthreads in args.nthreads:
+        pool = start_pool(nthreads, state_dir, total_mutations, args.min_total)
+        timings = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            scan_positions(pool, 1, positions)
+            timings.append(time.perf_counter() - start)
+        pool.close()
+        pool.join()
+
+        # the first scan also maps the tree into every worker, which a real run pays once; report the fastest
+        seconds = min(timings)
+        baseline = baseline or seconds
+        print(f"{nthreads}\t{seconds:.3f}\t{len(positions) / seconds:.1f}\t{baseline / seconds:.2f}")
+    shutil.rmtree(state_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "misc"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "qc"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spectrumSplits"))
+from synthetic_tree import generate_tree, use_stand_in
+use_stand_in()
+from flat_tree import FlatTree, AncestorIndex
+from spectrumSplits import find_splits, get_spectra, write_spectra_to_tsv, run_bootstrap, run_bootstrap_spectra
+from mask_site_splits import get_mutation_counts, write_generation, start_pool, scan_positions, find_site_splits, mask_mutations
+from prune_mutation_sample_ratio import compute_descendants_mutations_ratio, compute_threshold, detect_changepoints, prune_tree
+from process_bootstraps import read_spectra_file, process_bootstrap_files, intern_nodes, bootstrapSplits, getDistances, max_jaccard_similarity
+
+# Command-line argument parsing
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Time the pipeline on synthetic trees of several sizes and check that the planted splits and artifacts are found.")
+    parser.add_argument("--ntips", type=int, nargs="+", default=[10000, 50000, 200000], help="Tree sizes to run")
+    parser.add_argument("--mutation_rate", type=float, default=2.0, help="Mean number of mutations per branch")
+    parser.add_argument("--ladder", type=float, default=0.0, help="Probability of extending the most recent tip when growing the tree (1 builds a caterpillar)")
+    parser.add_argument("--nshifts", type=int, default=3, help="Number of clades with a planted spectrum shift")
+    parser.add_argument("--shift_strength", type=float, default=4.0, help="Fold change of the three shifted mutation types")
+    parser.add_argument("--nartifacts", type=int, default=2, help="Number of clades with a planted recurrent site")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the tree generator")
+    parser.add_argument("--min_chi", type=float, default=500, help="Minimum Chi-square value to accept a split")
+    parser.add_argument("--min_mutations", type=int, default=200, help="Minimum number of mutations required for a split")
+    parser.add_argument("--bootstraps", type=int, default=10, help="Bootstrap replicates of each kind")
+    parser.add_argument("--nthreads", type=int, default=1, help="Worker processes for find_splits, the split bootstrap and the site scan")
+    parser.add_argument("--min_total", type=int, default=500, help="mask_site_splits.py --min_total")
+    parser.add_argument("--min_count", type=int, default=50, help="mask_site_splits.py --min_count")
+    parser.add_argument("--mask_chi", type=float, default=5000, help="mask_site_splits.py --mask_chi")
+    parser.add_argument("--tolerance", type=int, default=1, help="A planted split or artifact site counts as found when a split, or the site's mask, is within this many branches of it")
+    return parser.parse_args(argv)
+
+@contextlib.contextmanager
+def quiet():
+    # the scripts report progress on stderr (and a few lines on stdout), which would drown the table
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+def timed(rows, ntips, task, function):
+    start = time.perf_counter()
+    with quiet():
+        result = function()
+    rows.append((ntips, task, f"{time.perf_counter() - start:.3f}"))
+    return result
+
+def run_scale(args, ntips, work_dir):
+    """Run every stage on one synthetic tree; returns the timing rows and the (check, passed, detail) results."""
+    rows = []
+    tree = timed(rows, ntips, "generate_tree", lambda: generate_tree(ntips, args.mutation_rate, args.ladder, args.nshifts, args.shift_strength, nartifacts=args.nartifacts, seed=args.seed))
+    flat_tree = timed(rows, ntips, "flatten", lambda: FlatTree.from_bte(tree))
+
+    # spectrumSplits.py
+    splits = timed(rows, ntips, "find_splits", lambda: find_splits(flat_tree, args.min_chi, args.min_mutations, nthreads=args.nthreads))
+    with quiet():
+        write_spectra_to_tsv(flat_tree, get_spectra(flat_tree, splits), "spectra_output.tsv", 0)
+    timed(rows, ntips, "bootstrap_splits", lambda: run_bootstrap(flat_tree, range(1, args.bootstraps + 1), args.nthreads, args.min_chi, args.min_mutations, seed=args.seed))
+    timed(rows, ntips, "bootstrap_spectra", lambda: run_bootstrap_spectra(flat_tree, range(1, args.bootstraps + 1), splits, seed=args.seed))
+
+    # misc/process_bootstraps.py
+    def process_bootstraps():
+        table, filenames = process_bootstrap_files(work_dir)
+        table = intern_nodes(flat_tree, table)
+        split_nodes = intern_nodes(flat_tree, read_spectra_file("spectra_output.tsv"))["node"].to_numpy()
+        bootstrap_nodes = table["node"].to_numpy()
+        replicates = table["replicate"].to_numpy()
+        replicate_nodes = [bootstrap_nodes[replicates == r] for r in range(len(filenames))]
+        bootstrapSplits(bootstrap_nodes, split_nodes, len(flat_tree))
+        getDistances(AncestorIndex(flat_tree), split_nodes, replicate_nodes)
+        jaccard = {}
+        for nodes in replicate_nodes:
+            max_jaccard_similarity(flat_tree, split_nodes.tolist(), nodes.tolist(), jaccard)
+    timed(rows, ntips, "process_bootstraps", process_bootstraps)
+
+    # qc/mask_site_splits.py, one iteration
+    def mask_sites():
+        mutation_counts = get_mutation_counts(flat_tree)
+        total_mutations = sum(mutation_counts.values())
+        positions = sorted((position for position, count in mutation_counts.items() if count >= args.min_count), key=lambda position: -mutation_counts[position])
+        write_generation(flat_tree, work_dir, 1)
+        pool = start_pool(args.nthreads, work_dir, total_mutations, args.min_total)
+        mask_dict = find_site_splits(scan_positions(pool, 1, positions), args)
+        pool.close()
+        pool.join()
+        mask_mutations(tree.root, mask_dict)
+        return mask_dict
+    mask_dict = timed(rows, ntips, "mask_site_splits", mask_sites)
+
+    # qc/prune_mutation_sample_ratio.py
+    def prune():
+        mutation_ratio = compute_descendants_mutations_ratio(flat_tree)
+        changepoints = list(detect_changepoints(flat_tree, mutation_ratio, compute_threshold(mutation_ratio)))
+        prune_tree(tree, [flat_tree.ids[child] for parent, child in changepoints])
+    timed(rows, ntips, "prune_mutation_sample_ratio", prune)
+
+    # the planted shifts should be found as splits, and the planted sites masked below their clades, both within --tolerance branches
+    ancestor_index = AncestorIndex(flat_tree)
+    split_list = sorted(splits)
+    recovered = sum(1 for node_id in tree.planted_shifts if min(ancestor_index.distance(flat_tree.index[node_id], split) for split in split_list) <= args.tolerance)
+    masked_below = {}
+    for node_id, positions in mask_dict.items():
+        for position in positions:
+            masked_below.setdefault(position, []).append(flat_tree.index[node_id])
+    masked = sum(1 for position, node_id in tree.artifact_sites.items() if min((ancestor_index.distance(flat_tree.index[node_id], node) for node in masked_below.get(position, [])), default=args.tolerance + 1) <= args.tolerance)
+    checks = [
+        ("planted_splits_recovered", recovered == len(tree.planted_shifts), f"{recovered}/{len(tree.planted_shifts)} ({len(splits) - 1} splits found)"),
+        ("artifact_sites_masked", masked == len(tree.artifact_sites), f"{masked}/{len(tree.artifact_sites)}"),
+    ]
+    return rows, checks
+
+def main():
+    args = parse_args()
+    print("ntips\ttask\tseconds")
+    failed = []
+    for ntips in args.ntips:
+        # the bootstraps write their files to the working directory, so each scale runs in a scratch one
+        work_dir = tempfile.mkdtemp(prefix="bench_synthetic.")
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            rows, checks = run_scale(args, ntips, work_dir)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work_dir)
+        for row in rows:
+            print("\t".join(map(str, row)))
+        for check, passed, detail in checks:
+            print(f"{ntips}\t{check}\t{'ok' if passed else 'FAILED'} {detail}", file=sys.stderr)
+            if not passed:
+                failed.append((ntips, check))
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spectrumSplits"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "qc"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "misc"))
+from synthetic_tree import generate_tree, use_stand_in
+use_stand_in()
+from flat_tree import FlatTree
+from tree_cache import load_matree
+from traversal import preorder, postorder, preorder_with_state
+from annotate_nodes import get_spectrum_roots
+from prune_mutation_sample_ratio import compute_descendants_mutations_ratio
+
+# Command-line argument parsing
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare the recursive tree walks the scripts used to do with the shared iterative traversals.")
+    parser.add_argument("--input_tree", type=str, default="public-latest.all.masked.pb.gz", help="Input tree file (protobuf format)")
+    parser.add_argument("--tree_cache", type=str, nargs="?", const="", default=None, help="Load the tree through the on-disk tree cache")
+    parser.add_argument("--ladder", type=int, default=0, help="Instead of reading a tree, build a synthetic ladder (caterpillar) tree with this many tips")
+    parser.add_argument("--nsplits", type=int, default=200, help="Number of random split nodes for the spectrum root annotation")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for choosing the split nodes")
+    return parser.parse_args()
+
+### the recursive walks as they were written in the scripts, kept here as the baseline
+def recursive_preorder(node, visit):
+    visit(node)
+    for child in node.children:
+        recursive_preorder(child, visit)
+
+def recursive_spectrum_roots(tree, subset_nodes_set):
+    annotations = {}
+    def traverse_and_annotate(node, current_ancestor):
+        if node.id in subset_nodes_set:
+            current_ancestor = node.id
+        annotations[node.id] = current_ancestor
+        for child in node.children:
+            traverse_and_annotate(child, current_ancestor)
+    traverse_and_annotate(tree.root, None)
+    return annotations
+
+def recursive_descendants_mutations_ratio(node, mutation_ratio):
+    if not node.children:
+        mutation_ratio[node.id] = len(node.mutations) / 1
+        return 1, len(node.mutations), [node.id]
+    total_tips = 0
+    total_mutations = len(node.mutations)
+    descendant_tips = []
+    for child in node.children:
+        child_tips, child_mutations, child_descendant_tips = recursive_descendants_mutations_ratio(child, mutation_ratio)
+        total_tips += child_tips
+        total_mutations += child_mutations
+        descendant_tips.extend(child_descendant_tips)
+    mutation_ratio[node.id] = total_mutations / total_tips if total_tips > 0 else float('inf')
+    return total_tips, total_mutations, descendant_tips
+
+def timed(function):
+    start = time.perf_counter()
+    try:
+        function()
+    except RecursionError:
+        return "RecursionError"
+    return f"{time.perf_counter() - start:.3f}"
+
+def main():
+    args = parse_args()
+    tree = generate_tree(args.ladder, ladder=1.0, nshifts=0, seed=args.seed) if args.ladder > 0 else load_matree(args.input_tree, args.tree_cache)
+
+    start = time.perf_counter()
+    flat_tree = FlatTree.from_bte(tree)
+    flatten_seconds = time.perf_counter() - start
+    internal = [flat_tree.ids[i] for i in range(len(flat_tree)) if not flat_tree.is_leaf[i] and i != flat_tree.root]
+    splits = set(random.Random(args.seed).sample(internal, min(args.nsplits, len(internal)))) | {flat_tree.ids[flat_tree.root]}
+    print(f"{len(flat_tree)} nodes, {len(splits)} splits, flattened in {flatten_seconds:.3f} s", file=sys.stderr)
+
+    def count_nodes(nodes):
+        return sum(1 for node in nodes)
+    def mark_spectrum_roots(node, current_ancestor):
+        return node.id if node.id in splits else current_ancestor
+
+    rows = [
+        ("walk", "recursive", lambda: recursive_preorder(tree.root, lambda node: None)),
+        ("walk", "preorder", lambda: count_nodes(preorder(tree.root))),
+        ("walk", "postorder", lambda: count_nodes(postorder(tree.root))),
+        ("spectrum_roots", "recursive", lambda: recursive_spectrum_roots(tree, splits)),
+        ("spectrum_roots", "preorder_with_state", lambda: {node.id: state for node, state in preorder_with_state(tree.root, None, mark_spectrum_roots)}),
+        ("spectrum_roots", "flat", lambda: get_spectrum_roots(flat_tree, splits)),
+        ("mutation_ratio", "recursive", lambda: recursive_descendants_mutations_ratio(tree.root, {})),
+        ("mutation_ratio", "flat", lambda: compute_descendants_mutations_ratio(flat_tree)),
+    ]
+    print("task\timplementation\tseconds")
+    for task, implementation, function in rows:
+        print(f"{task}\t{implementation}\t{timed(function)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import os
+import sys
+import pickle
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spectrumSplits"))
+from mutations import MUTATION_TYPES
+
+# Synthetic mutation annotated trees for the benchmarks, and a small in-process
+# stand-in for the parts of bte.MATree the scripts use. The stand-in keeps the
+# tree as plain Python objects; save_pb pickles it rather than writing a protobuf,
+# and MATree(path) reads such a pickle back.
+
+class SyntheticNode:
+    __slots__ = ("id", "children", "mutations", "parent")
+
+    def __init__(self, node_id, parent=None):
+        self.id = node_id
+        self.children = []
+        self.mutations = []
+        self.parent = parent
+
+    def is_leaf(self):
+        return not self.children
+
+    def update_mutations(self, mutations, update_branch_length=True):
+        self.mutations = list(mutations)
+
+class MATree:
+    """The bte.MATree interface used by the scripts: root, get_node, rsearch, remove_node and save_pb."""
+
+    def __init__(self, path=None):
+        self.root = None
+        self.nodes = {}
+        self.planted_shifts = []
+        self.artifact_sites = {}
+        if path is not None:
+            with open(path, "rb") as f:
+                self.__setstate__(pickle.load(f))
+
+    def get_node(self, node_id):
+        return self.nodes[node_id]
+
+    def rsearch(self, node_id, include_self=False):
+        node = self.nodes[node_id]
+        ancestors = [node] if include_self else []
+        node = node.parent
+        while node is not None:
+            ancestors.append(node)
+            node = node.parent
+        return ancestors
+
+    def remove_node(self, node_id):
+        """Detach a node and its subtree."""
+        node = self.nodes[node_id]
+        node.parent.children.remove(node)
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            del self.nodes[node.id]
+            stack.extend(node.children)
+
+    def save_pb(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self.__getstate__(), f)
+
+    # pickled as flat preorder lists, since deep trees overflow pickle's recursion
+    def __getstate__(self):
+        ids, parents, mutations = [], [], []
+        index = {}
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            index[node.id] = len(ids)
+            ids.append(node.id)
+            parents.append(index[node.parent.id] if node.parent is not None else -1)
+            mutations.append(node.mutations)
+            stack.extend(reversed(node.children))
+        return {"ids": ids, "parents": parents, "mutations": mutations, "planted_shifts": self.planted_shifts, "artifact_sites": self.artifact_sites}
+
+    def __setstate__(self, state):
+        nodes = []
+        for node_id, parent, mutations in zip(state["ids"], state["parents"], state["mutations"]):
+            node = SyntheticNode(node_id, nodes[parent] if parent >= 0 else None)
+            node.mutations = mutations
+            if node.parent is not None:
+                node.parent.children.append(node)
+            nodes.append(node)
+        self.root = nodes[0]
+        self.nodes = {node.id: node for node in nodes}
+        self.planted_shifts = state["planted_shifts"]
+        self.artifact_sites = state["artifact_sites"]
+
+def use_stand_in():
+    """Make `import bte` resolve to this module when the real library is not installed."""
+    try:
+        import bte
+    except ImportError:
+        sys.modules["bte"] = sys.modules[__name__]
+
+def random_topology(ntips, ladder, rng):
+    """
+    Parent index of every node of a random binary tree, root first. Tips are
+    split one at a time: with probability ladder the most recent tip, which
+    makes a caterpillar at ladder=1, and otherwise a uniformly chosen one.
+    """
+    parent = [-1]
+    tips = [0]
+    for _ in range(ntips - 1):
+        k = len(tips) - 1 if rng.random() < ladder else int(rng.integers(len(tips)))
+        node = tips[k]
+        tips[k] = tips[-1]
+        tips[-1] = len(parent)
+        tips.append(len(parent) + 1)
+        parent += [node, node]
+    return np.array(parent, dtype=np.int64)
+
+def clade_sizes(parent):
+    """Number of tips below every node; children always have larger indices than their parent."""
+    is_tip = np.ones(len(parent), dtype=bool)
+    is_tip[parent[1:]] = False
+    tips = is_tip.astype(np.int64)
+    for node in range(len(parent) - 1, 0, -1):
+        tips[parent[node]] += tips[node]
+    return tips, is_tip
+
+def is_ancestor(parent, ancestor, node):
+    while node >= 0:
+        if node == ancestor:
+            return True
+        node = int(parent[node])
+    return False
+
+def pick_clades(parent, tips, count, min_fraction, max_fraction, rng, exclude=()):
+    """Up to count internal nodes with min_fraction to max_fraction of the tips, none nested in another or in exclude."""
+    candidates = np.nonzero((tips >= min_fraction * tips[0]) & (tips <= max_fraction * tips[0]) & (tips > 1))[0]
+    picked = []
+    for node in rng.permutation(candidates).tolist():
+        if len(picked) == count:
+            break
+        if not any(is_ancestor(parent, other, node) or is_ancestor(parent, node, other) for other in picked + list(exclude)):
+            picked.append(node)
+    return picked
+
+def generate_tree(ntips, mutation_rate=2.0, ladder=0.0, nshifts=3, shift_strength=4.0, min_clade=0.05, max_clade=0.2, npositions=29903, nartifacts=0, artifact_rate=0.5, seed=1):
+    """
+    A random binary tree with ntips tips and Poisson(mutation_rate)
+    mutations per branch, drawn from one background spectrum. nshifts
+    disjoint clades with min_clade to max_clade of the tips get a spectrum
+    with three mutation types shift_strength times more frequent; their
+    node ids are kept in tree.planted_shifts. nartifacts clades also get a
+    recurrent mutation at a site of its own on artifact_rate of their
+    branches, the kind of imbalanced site mask_site_splits.py masks; these
+    are kept as position -> node id in tree.artifact_sites. ladder (0 to 1)
+    makes the tree deeper, see random_topology.
+    """
+    rng = np.random.default_rng(seed)
+    parent = random_topology(ntips, ladder, rng)
+    n = len(parent)
+    tips, is_tip = clade_sizes(parent)
+
+    # which spectrum every branch draws from: 0 for the background, k for the k-th planted clade
+    planted = pick_clades(parent, tips, nshifts, min_clade, max_clade, rng)
+    spectrum_class = np.zeros(n, dtype=np.int64)
+    for k, node in enumerate(planted):
+        spectrum_class[node] = k + 1
+    for node in range(1, n):
+        if spectrum_class[node] == 0:
+            spectrum_class[node] = spectrum_class[parent[node]]
+    background = rng.uniform(0.2, 1.2, size=12)
+    spectra = [background]
+    for _ in planted:
+        shifted = background.copy()
+        shifted[rng.choice(12, size=3, replace=False)] *= shift_strength
+        spectra.append(shifted)
+
+    # draw all mutations at once, one spectrum class at a time
+    counts = rng.poisson(mutation_rate, size=n)
+    counts[0] = 0
+    mutation_node = np.repeat(np.arange(n), counts)
+    mutation_type = np.zeros(len(mutation_node), dtype=np.int64)
+    for k, spectrum in enumerate(spectra):
+        in_class = spectrum_class[mutation_node] == k
+        mutation_type[in_class] = rng.choice(12, size=int(in_class.sum()), p=spectrum / spectrum.sum())
+    mutation_position = rng.integers(1, npositions + 1, size=len(mutation_node))
+    mutations = [[] for _ in range(n)]
+    for node, kind, position in zip(mutation_node.tolist(), mutation_type.tolist(), mutation_position.tolist()):
+        mutations[node].append(f"{MUTATION_TYPES[kind][0]}{position}{MUTATION_TYPES[kind][1]}")
+
+    # recurrent artifacts at positions past the end of the simulated genome
+    artifact_sites = {}
+    artifact_roots = pick_clades(parent, tips, nartifacts, min_clade, max_clade, rng, exclude=planted)
+    clade_of = np.full(n, -1, dtype=np.int64)
+    for k, node in enumerate(artifact_roots):
+        clade_of[node] = k
+    for node in range(1, n):
+        if clade_of[node] < 0:
+            clade_of[node] = clade_of[parent[node]]
+    for node in np.nonzero((clade_of >= 0) & (rng.random(n) < artifact_rate))[0].tolist():
+        if node not in artifact_roots:
+            mutations[node].append(f"C{npositions + 1 + int(clade_of[node])}T")
+
+    tree = MATree()
+    ids = [f"sample_{i}" if is_tip[i] else f"node_{i + 1}" for i in range(n)]
+    nodes = [SyntheticNode(ids[0])]
+    nodes[0].mutations = mutations[0]
+    for i in range(1, n):
+        node = SyntheticNode(ids[i], nodes[parent[i]])
+        node.mutations = mutations[i]
+        nodes[parent[i]].children.append(node)
+        nodes.append(node)
+    tree.root = nodes[0]
+    tree.nodes = {node.id: node for node in nodes}
+    tree.planted_shifts = [ids[node] for node in planted]
+    tree.artifact_sites = {npositions + 1 + k: ids[node] for k, node in enumerate(artifact_roots)}
+    return tree
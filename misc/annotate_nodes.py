@@ -1,8 +1,14 @@
 import os
 import re
+import sys
 import argparse
-import bte
 import pandas as pd
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spectrumSplits"))
+from tree_cache import load_flat_tree
+from traversal import preorder_indices
+from metrics import metrics, add_metrics_args, configure_metrics, finish_metrics
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Process bootstrap spectra output files.")
@@ -10,6 +16,8 @@ def parse_args():
     parser.add_argument("--input_tree", type=str, default="public-latest.all.masked.pb.gz", help="Input tree file (protobuf format)")
     parser.add_argument("--annotate_nodes_output_file", type=str, default="annotated_nodes_output.tsv", help="File to save annotated node data.")
     parser.add_argument("--metadata_output", type=str, default="metadata_output.tsv", help="File to save post-processed metadata.")
+    parser.add_argument("--tree_cache", type=str, nargs="?", const="", default=None, help="Load the tree through an on-disk cache, rebuilt when the input changes (optionally give the cache directory)")
+    add_metrics_args(parser)
     return parser.parse_args()
 
 def import_tsv_to_dict(tsv_file):
@@ -23,34 +31,26 @@ def import_tsv_to_dict(tsv_file):
             data[row_dict[header[0]]] = row_dict
     return data
 
-def get_spectrum_roots(tree, subset_nodes_set):
-    annotations = {}
-
-    def traverse_and_annotate(node, current_ancestor):
-        # If the node is in the subset, update the current ancestor
-        if node.id in subset_nodes_set:
-            current_ancestor = node.id
-        # Annotate the node and its tips with the current ancestor
-        annotations[node.id] = current_ancestor
-
-        # Recursively traverse children
-        for child in node.children:
-            traverse_and_annotate(child, current_ancestor)
-
-    # Start the traversal from the root
-    traverse_and_annotate(tree.root, None)
-
-    return annotations
+def get_spectrum_roots(flat_tree, subset_nodes_set):
+    """Map every node id, in preorder, to its closest ancestor-or-self in subset_nodes_set (None above all of them)."""
+    splits = np.array(sorted(flat_tree.index[node_id] for node_id in subset_nodes_set), dtype=np.int64)
+    owner = flat_tree.region_owner(splits)
+    split_ids = [flat_tree.ids[split] for split in splits.tolist()] + [None]
+    return {flat_tree.ids[node]: split_ids[owner[node]] for node in preorder_indices(flat_tree).tolist()}
 
 if __name__ == "__main__":
     # Take input data
     args = parse_args()
+    configure_metrics(args)
     spectra_data = import_tsv_to_dict(args.spectrum_file)
     splits = set(spectra_data.keys())
-    tree = bte.MATree(args.input_tree)
+    with metrics.phase("load_tree"):
+        flat_tree = load_flat_tree(args.input_tree, args.tree_cache)
 
     # Get the parent in the splits
-    spectrum_roots = get_spectrum_roots(tree, splits)
+    with metrics.phase("spectrum_roots"):
+        spectrum_roots = get_spectrum_roots(flat_tree, splits)
+    metrics.count("nodes_visited", len(flat_tree))
 
     # Create a DataFrame to store the results
     result_data = {
@@ -82,9 +82,11 @@ if __name__ == "__main__":
     # Convert result data into a pandas DataFrame
     df = pd.DataFrame(result_data)
 
-    # Save the annotated node data
-    df.to_csv(args.annotate_nodes_output_file, sep='\t', index=False)
+    with metrics.phase("write_output"):
+        # Save the annotated node data
+        df.to_csv(args.annotate_nodes_output_file, sep='\t', index=False)
 
-    # Post-process to rename 'NodeID' to 'strain' and save the output
-    df.rename(columns={"NodeID": 'strain'}, inplace=True)  # rename the 'NodeID' column to 'strain'
-    df.to_csv(args.metadata_output, sep='\t', index=False)  # save it as a .tsv extension
+        # Post-process to rename 'NodeID' to 'strain' and save the output
+        df.rename(columns={"NodeID": 'strain'}, inplace=True)  # rename the 'NodeID' column to 'strain'
+        df.to_csv(args.metadata_output, sep='\t', index=False)  # save it as a .tsv extension
+    finish_metrics(args)
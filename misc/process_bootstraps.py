@@ -1,139 +1,170 @@
 import os
 import re
 import argparse
-import bte
 import pandas as pd
+import numpy as np
 import sys
+from collections import defaultdict
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spectrumSplits"))
+from flat_tree import AncestorIndex
+from mutations import MUTATION_TYPES
+from bootstrap_store import read_bootstrap_store
+from tree_cache import load_flat_tree
+from metrics import metrics, add_metrics_args, configure_metrics, finish_metrics
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Process bootstrap spectra output files.")
     parser.add_argument('--bootstrap_directory', type=str, default="./", help="Directory containing the bootstrap spectra output files.")
     parser.add_argument('--spectrum_file', type=str, default="spectra_output.tsv", help="Spectrum file computed from the tree.")
     parser.add_argument("--input_tree", type=str, default="public-2024-08-06.masked.pb.gz", help="Input tree file (protobuf format)")
+    parser.add_argument("--tree_cache", type=str, nargs="?", const="", default=None, help="Load the tree through an on-disk cache, rebuilt when the input changes (optionally give the cache directory)")
+    parser.add_argument("--bootstrap_store", type=str, default=None, help="Read the split bootstraps from this store (written with spectrumSplits.py --bootstrap_store) instead of the directory")
+    parser.add_argument("--nthreads", type=int, default=1, help="Number of processes reading bootstrap files")
+    add_metrics_args(parser)
     return parser.parse_args()
 
-def import_tsv_to_dict(tsv_file):
-    """Read TSV file and store data in a dictionary."""
-    data = {}
-    with open(tsv_file, 'r') as f:
-        header = f.readline().strip().split('\t')
-        for line in f:
-            values = line.strip().split('\t')
-            row_dict = {header[i]: values[i] for i in range(len(header)-1)}
-            data[row_dict[header[0]]] = row_dict
-    return data
-
-def process_bootstrap_files(bootstrap_dir):
-    """Process bootstrap files from the specified directory."""
+def read_spectra_file(path):
+    """Read a spectra TSV into columns: the node id and the 12 normalized spectrum values of every split."""
+    return pd.read_csv(path, sep="\t", usecols=["Node_ID"] + MUTATION_TYPES, dtype={"Node_ID": str, **{column: np.float64 for column in MUTATION_TYPES}})
+
+def process_bootstrap_files(bootstrap_dir, nthreads=1):
+    """
+    Read the bootstrap split files of a directory, nthreads at a time, into
+    one table with a replicate column numbering the files in directory
+    listing order. Returns the table and the file names.
+    """
     regex = re.compile(r'bootstrap_(\d+)_splits_output.tsv')
-    spectra_dict = {}
-    for filename in os.listdir(bootstrap_dir):
-        if regex.match(filename):
-            file_path = os.path.join(bootstrap_dir, filename)
-            spectra_dict[filename] = import_tsv_to_dict(file_path)
-    return spectra_dict
-
-def bootstrapSplits(bootstrap_data, spectra_data):
-    """Calculate support rates for each node in the bootstrap data."""
-    rates = {}
-    for replicate in bootstrap_data.keys():
-        for node in bootstrap_data[replicate].keys():
-            if node not in rates:
-                rates[node] = 0
-            rates[node] += 1
-    recovery = {node: rates.get(node, 0) for node in spectra_data}
-    return recovery
-
-def nodeDistance(tree, node1, node2):
-    """Calculate the distance between two nodes in the tree."""
-    possible_lcas_order = [node1]
-    if node1 != "node_1":
-        possible_lcas_order.extend([anc.id for anc in tree.rsearch(node1)])
-    possible_lcas = set(possible_lcas_order)
-
-    new_ancestors_order = [node2]
-    if node2 != "node_1":
-        new_ancestors_order.extend([anc.id for anc in tree.rsearch(node2)])
-    new_ancestors = set(new_ancestors_order)
-
-    possible_lcas = possible_lcas.intersection(new_ancestors)
-    LCA = next(pl for pl in possible_lcas_order if pl in possible_lcas)
-    
-    return possible_lcas_order.index(LCA) + new_ancestors_order.index(LCA)
-
-def getDistances(tree, splits, bootstrap_spectra_data):
-    """Get distance to the nearest split for each node."""
-    distanceDict = {}
-    for node in splits:
-        distances = []
-        for replicate in bootstrap_spectra_data.keys():
-            minDist = 1000000
-            if node in bootstrap_spectra_data[replicate].keys():
-                minDist = 0
-            else:
-                for replicateNode in bootstrap_spectra_data[replicate].keys():
-                    dist = nodeDistance(tree, node, replicateNode)
-                    minDist = min(minDist, dist)
-            distances.append(minDist)
-        distanceDict[node] = distances
-    return distanceDict
-
-def get_spectrum_roots(tree, subset_nodes_set):
-    """Get the spectrum roots by annotating the tree nodes."""
-    annotations = {}
-    def traverse_and_annotate(node, current_ancestor):
-        if node.id in subset_nodes_set:
-            current_ancestor = node.id
-        if current_ancestor not in annotations:
-            annotations[current_ancestor] = []
-        annotations[current_ancestor].append(node.id)
-        for child in node.children:
-            traverse_and_annotate(child, current_ancestor)
-    traverse_and_annotate(tree.root, None)
-    return annotations
-
-def jaccard_similarity(set1, set2):
-    """Calculate Jaccard similarity between two sets."""
-    intersection = set1.intersection(set2)
-    union = set1.union(set2)
-    if not union:
-        return 0.0
-    return len(intersection) / len(union)
-
-### consider minhashing this
-def max_jaccard_similarity(dict1, dict2, result):
-    """Find the maximum Jaccard similarity for each key in dict1 against all keys in dict2."""
-    for key1, set1 in dict1.items():
-        max_similarity = 0.0
-        best_match = None
-        for key2, set2 in dict2.items():
-            similarity = jaccard_similarity(set1, set2)
-            if similarity > max_similarity:
-                max_similarity = similarity
-                best_match = key2
-        if key1 not in result :
-            result[key1] = [max_similarity]
-        else :
-            result[key1].append( max_similarity )
+    filenames = [filename for filename in os.listdir(bootstrap_dir) if regex.match(filename)]
+    paths = [os.path.join(bootstrap_dir, filename) for filename in filenames]
+    if nthreads > 1:
+        with Pool(nthreads) as pool:
+            tables = pool.map(read_spectra_file, paths)
+    else:
+        tables = [read_spectra_file(path) for path in paths]
+    for replicate, table in enumerate(tables):
+        table.insert(0, "replicate", np.int32(replicate))
+    if not tables:
+        return pd.DataFrame(columns=["replicate", "Node_ID"] + MUTATION_TYPES), filenames
+    return pd.concat(tables, ignore_index=True), filenames
+
+def read_store_table(store_path):
+    """The split bootstraps of a store as the table process_bootstrap_files builds, with replicates in numeric order."""
+    columns = read_bootstrap_store(store_path, "splits")
+    replicates, replicate_index = np.unique(columns["replicate"], return_inverse=True)
+    table = pd.DataFrame(columns["spectrum"], columns=MUTATION_TYPES)
+    table.insert(0, "Node_ID", columns["node_id"])
+    table.insert(0, "replicate", replicate_index.astype(np.int32))
+    return table, [f"replicate {replicate}" for replicate in replicates.tolist()]
+
+def intern_nodes(flat_tree, table):
+    """Replace the node id column of a spectra table by a node column holding the node's index in flat_tree."""
+    codes, node_ids = pd.factorize(table["Node_ID"])
+    node_index = np.array([flat_tree.index[node_id] for node_id in node_ids], dtype=np.int32)
+    table.insert(table.columns.get_loc("Node_ID"), "node", node_index[codes] if len(codes) else np.zeros(0, dtype=np.int32))
+    return table.drop(columns="Node_ID")
+
+def bootstrapSplits(bootstrap_nodes, split_nodes, nnodes):
+    """Calculate support counts for each split: the number of replicates in which the same node is a split."""
+    return np.bincount(bootstrap_nodes, minlength=nnodes)[split_nodes]
+
+def getDistances(ancestor_index, split_nodes, replicate_nodes):
+    """Get distance to the nearest split in each replicate for each split, as a splits x replicates array."""
+    distances = np.full((len(split_nodes), len(replicate_nodes)), 1000000, dtype=np.int64)
+    for replicate, nodes in enumerate(replicate_nodes):
+        if len(nodes) == 0:
+            continue
+        # all split x replicate node pairs at once; a split present in the replicate is at distance 0
+        pair_distances = ancestor_index.distance(np.repeat(split_nodes, len(nodes)), np.tile(nodes, len(split_nodes)))
+        distances[:, replicate] = pair_distances.reshape(len(split_nodes), len(nodes)).min(axis=1)
+    return distances
+
+def region_overlaps(flat_tree, reference_splits, bootstrap_splits):
+    """
+    Number of tree nodes shared by every overlapping pair of regions of two
+    split sets, where a split's region is its subtree minus the subtrees of
+    splits below it and None stands for the nodes above every split.
+
+    Subtrees are contiguous postorder intervals, so one sweep over the
+    interval ends of both split sets cuts the tree into segments lying in a
+    single region of each; only overlapping pairs are ever visited.
+    """
+    events = []
+    for family, splits in enumerate((reference_splits, bootstrap_splits)):
+        for split in splits:
+            # at a shared start the enclosing (larger) split opens first; closes come before opens
+            events.append((int(flat_tree.subtree_start[split]), 1, -split, family, split))
+            events.append((split + 1, 0, 0, family, split))
+    events.sort()
+
+    overlaps = defaultdict(int)
+    open_splits = ([None], [None])
+    position = 0
+    for point, is_open, _, family, split in events + [(len(flat_tree), 0, 0, None, None)]:
+        if point > position:
+            overlaps[(open_splits[0][-1], open_splits[1][-1])] += point - position
+            position = point
+        if family is None:
+            break
+        if is_open:
+            open_splits[family].append(split)
+        else:
+            open_splits[family].pop()
+    return overlaps
+
+def max_jaccard_similarity(flat_tree, reference_splits, bootstrap_splits, result):
+    """Find the maximum Jaccard similarity of each reference split region against all regions of a bootstrap replicate."""
+    overlaps = region_overlaps(flat_tree, reference_splits, bootstrap_splits)
+    reference_sizes = defaultdict(int)
+    bootstrap_sizes = defaultdict(int)
+    for (key1, key2), intersection in overlaps.items():
+        reference_sizes[key1] += intersection
+        bootstrap_sizes[key2] += intersection
+
+    max_similarity = {key1: 0.0 for key1 in reference_sizes}
+    for (key1, key2), intersection in overlaps.items():
+        similarity = intersection / (reference_sizes[key1] + bootstrap_sizes[key2] - intersection)
+        if similarity > max_similarity[key1]:
+            max_similarity[key1] = similarity
+    for key1, similarity in max_similarity.items():
+        result.setdefault(key1, []).append(similarity)
     return result
 
 if __name__ == "__main__":
     args = parse_args()
-    bootstrap_spectra_data = process_bootstrap_files(args.bootstrap_directory)
-    spectra_data = import_tsv_to_dict(args.spectrum_file)
-    tree = bte.MATree(args.input_tree)
+    configure_metrics(args)
+    with metrics.phase("load_tree"):
+        flat_tree = load_flat_tree(args.input_tree, args.tree_cache)
+
+    # every replicate's splits in one table, with node ids interned to node indices
+    with metrics.phase("read_bootstraps"):
+        if args.bootstrap_store is None:
+            bootstrap_table, bootstrap_files = process_bootstrap_files(args.bootstrap_directory, args.nthreads)
+        else:
+            bootstrap_table, bootstrap_files = read_store_table(args.bootstrap_store)
+        bootstrap_table = intern_nodes(flat_tree, bootstrap_table)
+        spectra_table = intern_nodes(flat_tree, read_spectra_file(args.spectrum_file))
+    metrics.count("replicates_read", len(bootstrap_files))
+    metrics.count("bootstrap_splits_read", len(bootstrap_table))
+    split_nodes = spectra_table["node"].to_numpy()
+    bootstrap_nodes = bootstrap_table["node"].to_numpy()
+    replicate_offsets = np.searchsorted(bootstrap_table["replicate"].to_numpy(), np.arange(len(bootstrap_files) + 1))
+    replicate_nodes = [bootstrap_nodes[replicate_offsets[r]:replicate_offsets[r + 1]] for r in range(len(bootstrap_files))]
 
     # Calculate support probabilities and distances
-    supportProps = bootstrapSplits(bootstrap_spectra_data, spectra_data)
-    nearestSplitDistance = getDistances(tree, supportProps.keys(), bootstrap_spectra_data)
+    with metrics.phase("distances"):
+        supportProps = bootstrapSplits(bootstrap_nodes, split_nodes, len(flat_tree))
+        nearestSplitDistance = getDistances(AncestorIndex(flat_tree), split_nodes, replicate_nodes)
 
-    # Get spectrum roots as sets for faster Jaccard similarity calculations
+    # Compare the split regions of the reference with those of every replicate
     bootstrap_jaccard = {}
-    spectrum_tips = {key: set(values) for key, values in get_spectrum_roots(tree, spectra_data.keys()).items()}
-    for bootstrap in bootstrap_spectra_data.keys():
-        print( "computing jaccard for bootstrap: ", bootstrap, file=sys.stderr )
-        bootstrap_spectrum_tips = {key: set(values) for key, values in get_spectrum_roots(tree, bootstrap_spectra_data[bootstrap].keys()).items()}
-        bootstra_jaccard = max_jaccard_similarity(spectrum_tips, bootstrap_spectrum_tips, bootstrap_jaccard) 
-
-    for node, prob in supportProps.items():
-        print(node, prob / len(bootstrap_spectra_data.keys()), sum(nearestSplitDistance[node]) / len(nearestSplitDistance[node]), sum(bootstrap_jaccard[node])/len(bootstrap_jaccard[node]), ','.join(map(str, nearestSplitDistance[node])), ','.join(map(str,bootstrap_jaccard[node])))
+    with metrics.phase("jaccard"):
+        for bootstrap, nodes in zip(bootstrap_files, replicate_nodes):
+            print( "computing jaccard for bootstrap: ", bootstrap, file=sys.stderr )
+            max_jaccard_similarity(flat_tree, split_nodes.tolist(), nodes.tolist(), bootstrap_jaccard)
+
+    with metrics.phase("write_output"):
+        for node, prob, distances in zip(split_nodes.tolist(), supportProps.tolist(), nearestSplitDistance.tolist()):
+            print(flat_tree.ids[node], prob / len(bootstrap_files), sum(distances) / len(distances), sum(bootstrap_jaccard[node])/len(bootstrap_jaccard[node]), ','.join(map(str, distances)), ','.join(map(str,bootstrap_jaccard[node])))
+    finish_metrics(args)
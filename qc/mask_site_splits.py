@@ -1,10 +1,19 @@
 import bte
+import os
 import sys
+import shutil
 import argparse
-from scipy.stats import chi2_contingency
+import tempfile
+import numpy as np
 from collections import defaultdict
-from multiprocessing import Process, Manager
-import re
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spectrumSplits"))
+from flat_tree import FlatTree
+from mutations import encode_mutation, mutation_position
+from tree_cache import write_cache, read_cache
+from traversal import preorder_with_state
+from metrics import metrics, add_metrics_args, configure_metrics, finish_metrics
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Process a phylogenetic tree to mask highly imbalanced mutations.")
@@ -12,137 +21,265 @@ def parse_args():
     parser.add_argument("--output_tree", type=str, default="masked_sites.pb.gz", help="Output tree file (protobuf format)")
     parser.add_argument("--min_total", type=int, default=500, help="Minimum mutation count to accept a split")
     parser.add_argument("--min_count", type=int, default=50, help="Minimum mutation count to accept a split")
-    parser.add_argument("--nthreads", type=int, default=100, help="Number of concurrent threads for processing")
+    parser.add_argument("--nthreads", type=int, default=100, help="Number of worker processes scanning sites")
     parser.add_argument("--mask_chi", type=float, default=5000, help="Minimum chi2 value for masking mutation below a node (defaults to off)")
+    add_metrics_args(parser)
     return parser.parse_args()
 
-def get_position_from_mutation(mutation):
+def get_mutation_counts(flat_tree):
+    positions, counts = np.unique(flat_tree.mutation_position, return_counts=True)
+    return dict(zip(positions.tolist(), counts.tolist()))
+
+def site_chi2_statistics(total_above, snps_above, total_below, snps_below):
     """
-    Extracts the position from a mutation string.
-    Mutation strings are of the form \D\d+\D, where \d+ is the numeric position.
+    Chi-square statistic of the 2 x 2 table [[total_above, snps_above],
+    [total_below, snps_below]] for arrays of tables, with Yates' correction.
+    The arithmetic follows scipy.stats.chi2_contingency term for term, so the
+    statistics are identical to calling it once per table. Tables with a zero
+    expected frequency, which chi2_contingency rejects, score 0.
     """
-    match = re.search(r'\d+', mutation)
-    if match:
-        return int(match.group(0))  # Return the numeric part as an integer
-    return None
-
-def get_mutation_counts(node):
-    mutation_counts = defaultdict(int)
-
-    def traverse_tree(node):
-        for mutation in node.mutations:
-            position = get_position_from_mutation(mutation)
-            if position is not None:
-                mutation_counts[position] += 1
-        for child in node.children:
-            traverse_tree(child)
-
-    traverse_tree(node)
-    return dict(mutation_counts)
-
-def process_mutation(tree, position, count, total_mutations, args, mask_dict, chi_list):
-    """Process one mutation split."""
-    find_site_splits(position, count, total_mutations, tree.root, args, mask_dict, chi_list)
-
-def run_in_process(tree, position, count, total_mutations, args, mask_dict, chi_list):
-    """Helper function to run in a separate process."""
-    p = Process(target=process_mutation, args=(tree, position, count, total_mutations, args, mask_dict, chi_list))
-    p.start()
-    return p   
-
-def find_site_splits(position, mutation_count, total_mutations, root, args, mask_dict, chi_list):
-
-    mutation_memo = {}
-    total_memo = {}
-    max_chi = 0
-    max_node = root
-
-    def traverse_and_count(node):
-        nonlocal max_chi, max_node  # Declare that we want to modify the outer scope variables so we can do the recursion
-
-        if node.id in mutation_memo:
-            return mutation_memo[node.id], total_memo[node.id]
-
-        mutation_occurrences = 0
-        total_descendant_mutations = len(node.mutations)
-
-        for mutation in node.mutations:
-            if get_position_from_mutation(mutation) == position:
-                mutation_occurrences += 1
-
-        for child in node.children:
-            child_mutation_count, child_total_count = traverse_and_count(child)
-            mutation_occurrences += child_mutation_count
-            total_descendant_mutations += child_total_count
-
-        mutation_memo[node.id] = mutation_occurrences
-        total_memo[node.id] = total_descendant_mutations
-
-        snps_above = mutation_count - mutation_memo[node.id] 
-        total_above = total_mutations - total_memo[node.id] - snps_above
-
-        if total_above > args.min_total and total_memo[node.id] > args.min_total:
-            observed = [[total_above, snps_above], [total_memo[node.id]-mutation_memo[node.id], mutation_memo[node.id]]]
-            chi2, p, dof, expected = chi2_contingency(observed)
-
-            if chi2 > max_chi:
-                max_chi = chi2
-                max_node = node
-
-        return mutation_occurrences, total_descendant_mutations
-
-    traverse_and_count(root)
-    
-    # Add to mask_dict if max_chi exceeds the threshold
-    if max_chi > args.mask_chi:
-        current_nodes = mask_dict.get(max_node.id, [])  # Get the list if it exists, otherwise get an empty list
-        current_nodes.append(position)
-        mask_dict[max_node.id] = current_nodes  # Reassign the updated list back to the dictionary
-
-    # Append chi result to chi_list
-    chi_list.append((position, max_chi, max_node.id))
+    observed = np.stack([total_above, snps_above, total_below, snps_below], axis=1).astype(np.int64)
+    rows = [observed[:, 0] + observed[:, 1], observed[:, 2] + observed[:, 3]]
+    cols = [observed[:, 0] + observed[:, 2], observed[:, 1] + observed[:, 3]]
+    expected = np.stack([rows[0] * cols[0], rows[0] * cols[1], rows[1] * cols[0], rows[1] * cols[1]], axis=1) / (rows[0] + rows[1])[:, None]
+    valid = np.all(expected > 0, axis=1)
+    diff = expected - observed
+    corrected = observed + np.minimum(0.5, np.abs(diff)) * np.sign(diff)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms = (corrected - expected) ** 2 / expected
+    chi = ((terms[:, 0] + terms[:, 1]) + terms[:, 2]) + terms[:, 3]
+    return np.where(valid, chi, 0.0)
+
+def scan_setup(flat_tree):
+    """
+    The parts of a site scan that depend only on the tree, computed once per
+    tree and shared by every scan_sites call on it: the mutations as sorted
+    (position rank, node) keys, the subtree totals, all nodes ordered by
+    decreasing total and the depth of every node.
+    """
+    n = len(flat_tree)
+    all_positions = np.unique(flat_tree.mutation_position)
+    keys = np.sort(np.searchsorted(all_positions, flat_tree.mutation_position) * n + flat_tree.mutation_node)
+    parent = np.asarray(flat_tree.parent, dtype=np.int64)
+    subtree_start = np.asarray(flat_tree.subtree_start, dtype=np.int64)
+    total_memo = flat_tree.subtree_sums(flat_tree.branch_length)
+    # all nodes by decreasing subtree total, postorder within equal totals
+    by_total = np.lexsort((np.arange(n), -total_memo))
+    # a node lies within the subtree bounds of itself and each of its ancestors
+    depth = np.cumsum(np.bincount(subtree_start, minlength=n) - np.bincount(np.arange(1, n), minlength=n)) - 1
+    return dict(all_positions=all_positions, keys=keys, parent=parent, subtree_start=subtree_start,
+                total_memo=total_memo, by_total=by_total, descending_totals=-total_memo[by_total], depth=depth)
+
+def scan_sites(flat_tree, mutation_counts, total_mutations, min_total, block_size=32, setup=None):
+    """
+    Find the most imbalanced node for every position in mutation_counts at
+    once. Returns a dict position -> (max_chi, node index), where the node is
+    the root and max_chi 0 when no node passes the min_total filters.
+
+    A node with no occurrence of the position below it scores a chi that
+    only grows with its total mutation count, so per position only the
+    ancestors of its mutated nodes are scored individually, plus the largest
+    eligible node outside them. Positions are processed in blocks, walking up
+    from all of a block's mutated nodes together. setup is scan_setup of the
+    tree, computed here when not given.
+    """
+    n = len(flat_tree)
+    positions = np.array(sorted(mutation_counts), dtype=np.int64)
+    counts = np.array([mutation_counts[position] for position in positions.tolist()], dtype=np.int64)
+    results = {}
+    if len(positions) == 0:
+        return results
+
+    if setup is None:
+        setup = scan_setup(flat_tree)
+    keys, parent, subtree_start, depth = setup["keys"], setup["parent"], setup["subtree_start"], setup["depth"]
+    total_memo, by_total, descending_totals = setup["total_memo"], setup["by_total"], setup["descending_totals"]
+    # each scanned position's range of keys; positions without mutations in the tree get an empty one
+    rank = np.searchsorted(setup["all_positions"], positions)
+    present = rank < len(setup["all_positions"])
+    present[present] = setup["all_positions"][rank[present]] == positions[present]
+    key_start = np.searchsorted(keys, rank * n)
+    key_end = np.where(present, np.searchsorted(keys, (rank + 1) * n), key_start)
+
+    for lo in range(0, len(positions), block_size):
+        hi = min(lo + block_size, len(positions))
+        # the block's mutations as (position within the block, node) keys
+        block_keys = np.unique(np.concatenate([keys[key_start[p]:key_end[p]] - rank[p] * n + (p - lo) * n for p in range(lo, hi)]))
+
+        # every (position, ancestor of a mutated node) pair of the block, walking up one depth at a time
+        # so that paths meet in the same step and each pair is visited once
+        closure = []
+        block_keys = block_keys[np.argsort(-depth[block_keys % n], kind="stable")]
+        block_depths = -depth[block_keys % n]
+        frontier = block_keys[:0]
+        level = -block_depths[0] if len(block_keys) else -1
+        while level >= 0:
+            joining = block_keys[np.searchsorted(block_depths, -level):np.searchsorted(block_depths, -level, side="right")]
+            frontier = np.unique(np.concatenate((frontier, joining)))
+            closure.append(frontier)
+            nodes = frontier % n
+            frontier = (frontier - nodes + parent[nodes])[parent[nodes] >= 0]
+            level -= 1
+        closure = np.concatenate(closure) if closure else block_keys
+        local = closure // n
+        nodes = closure % n
+
+        # occurrences of the position below each node, counted between the node's subtree bounds
+        global_keys = rank[lo + local] * n + nodes
+        mutation_memo = np.searchsorted(keys, global_keys, side="right") - np.searchsorted(keys, global_keys - nodes + subtree_start[nodes], side="left")
+        mutation_count = counts[lo + local]
+        snps_above = mutation_count - mutation_memo
+        total_above = total_mutations - total_memo[nodes] - snps_above
+        eligible = (total_above > min_total) & (total_memo[nodes] > min_total)
+        local, nodes = local[eligible], nodes[eligible]
+        chi = site_chi2_statistics(total_above[eligible], snps_above[eligible], total_memo[nodes] - mutation_memo[eligible], mutation_memo[eligible])
+        metrics.count("pairs_walked", len(closure))
+        metrics.count("chi2_tests", len(chi))
+
+        # best scored node per position, ties going to the first node in postorder
+        best = {}
+        order = np.lexsort((nodes, -chi, local))
+        first = order[np.r_[True, local[order][1:] != local[order][:-1]]] if len(order) else order
+        for k in first.tolist():
+            best[int(local[k])] = (float(chi[k]), int(nodes[k]))
+
+        closure = np.sort(closure)
+        closure_sizes = np.bincount(closure // n, minlength=hi - lo)
+        for k in range(hi - lo):
+            position, count = int(positions[lo + k]), int(counts[lo + k])
+            max_chi, max_node = best.get(k, (0.0, flat_tree.root))
+
+            # the largest node below the total_above bound that has no occurrence of the position
+            bound = total_mutations - count - min_total
+            start = np.searchsorted(descending_totals, -bound, side="right")
+            window = by_total[start:start + closure_sizes[k] + 1]
+            window_keys = k * n + window
+            found = np.searchsorted(closure, window_keys)
+            walked = found < len(closure)
+            walked[walked] = closure[found[walked]] == window_keys[walked]
+            free = window[~walked]
+            if len(free) > 0 and total_memo[free[0]] > min_total:
+                node = int(free[0])
+                total = total_memo[node : node + 1]
+                free_chi = float(site_chi2_statistics(total_mutations - total - count, [count], total, [0])[0])
+                if free_chi > max_chi or (free_chi == max_chi and node < max_node):
+                    max_chi, max_node = free_chi, node
+
+            results[position] = (max_chi, max_node) if max_chi > 0 else (0, flat_tree.root)
+    metrics.count("sites_scanned", len(positions))
+    return results
+
+### per-worker state: the flattened tree of the current masking iteration, loaded on demand
+worker_state = {}
+
+def init_worker(state_dir, total_mutations, min_total):
+    worker_state.update(state_dir=state_dir, total_mutations=total_mutations, min_total=min_total, generation=None)
+
+def generation_path(state_dir, generation):
+    return os.path.join(state_dir, f"generation_{generation}")
+
+def write_generation(flat_tree, state_dir, generation):
+    """Publish the flattened tree of a masking iteration for the workers to memory map."""
+    write_cache(flat_tree, generation_path(state_dir, generation), None, "")
+
+def scan_worker(task):
+    """
+    Scan a chunk of positions against the given generation of the tree,
+    returning (position, chi, node_id) tuples and the chunk's counters.
+    """
+    generation, positions = task
+    counters = metrics.snapshot()
+    if worker_state["generation"] != generation:
+        flat_tree = read_cache(generation_path(worker_state["state_dir"], generation))
+        worker_state.update(generation=generation, flat_tree=flat_tree, mutation_counts=get_mutation_counts(flat_tree), setup=scan_setup(flat_tree))
+    flat_tree = worker_state["flat_tree"]
+    results = scan_sites(flat_tree, {position: worker_state["mutation_counts"][position] for position in positions}, worker_state["total_mutations"], worker_state["min_total"], setup=worker_state["setup"])
+    return [(position, chi, flat_tree.ids[node]) for position, (chi, node) in results.items()], metrics.counts_since(counters)
+
+def start_pool(nthreads, state_dir, total_mutations, min_total):
+    """Worker pool kept for the whole run; only generation numbers and position ids are sent to it."""
+    return Pool(nthreads, initializer=init_worker, initargs=(state_dir, total_mutations, min_total))
+
+def scan_positions(pool, generation, positions, chunk_size=32):
+    """
+    Scan positions on the pool, most frequent first so the longest chunks
+    start early, and collect the (position, chi, node_id) results.
+    """
+    tasks = [(generation, positions[lo:lo + chunk_size]) for lo in range(0, len(positions), chunk_size)]
+    chi_list = []
+    for results, counts in pool.imap_unordered(scan_worker, tasks):
+        chi_list.extend(results)
+        metrics.add_counts(counts)
+    return chi_list
+
+def find_site_splits(chi_list, args):
+    """Group the positions whose max chi exceeds mask_chi by the node to mask them below."""
+    mask_dict = {}
+    for position, max_chi, max_node_id in chi_list:
+        if max_chi > args.mask_chi:
+            mask_dict.setdefault(max_node_id, []).append(position)
+    return mask_dict
 
 def mask_mutations(root, mask_dict):
     """
-    Perform a DFS traversal of the tree and for each node in mask_dict,
-    remove the listed mutations from all descendant nodes using update_mutations.
+    Walk the tree once and, for each node in mask_dict, remove the listed
+    mutations from all of its descendants. The masked positions are carried
+    down each path, so overlapping masked clades are handled in the same
+    pass, and update_mutations is only called on nodes that lose mutations.
+    Returns the number of nodes updated and the number of mutations removed
+    at each position.
     """
-    def dfs(node):
-        if node.id in mask_dict:
-            positions_to_mask = mask_dict[node.id]
-            print(f"Masking mutations at positions {positions_to_mask} in descendants of node {node.id}", file = sys.stderr)
-
-            # Recursively mask mutations in descendants
-            def remove_mutations(descendant):
-                # Create a set of positions of current mutations for the descendant
-                current_positions = set(get_position_from_mutation(m) for m in descendant.mutations)
-                # Calculate remaining positions after masking
-                remaining_positions = current_positions - set(positions_to_mask)
-                # Update the descendant's mutations with the remaining ones
-                remaining_mutations = [m for m in descendant.mutations if get_position_from_mutation(m) in remaining_positions]
-                descendant.update_mutations(remaining_mutations, update_branch_length=True)
-
-                # Continue removing mutations for each child of this descendant
-                for child in descendant.children:
-                    remove_mutations(child)
-
-            # Start masking from the children of the current node
-            for child in node.children:
-                remove_mutations(child)
-
-        # Continue DFS to check children nodes
-        for child in node.children:
-            dfs(child)
-
-    # Start the DFS traversal from the root node
-    dfs(root)
+    nodes_updated = 0
+    removed_counts = defaultdict(int)
+
+    def inherit_mask(node, masked):
+        if node.id not in mask_dict:
+            return masked
+        positions_to_mask = mask_dict[node.id]
+        print(f"Masking mutations at positions {positions_to_mask} in descendants of node {node.id}", file = sys.stderr)
+        return masked | frozenset(positions_to_mask)
+
+    for node, masked in preorder_with_state(root, frozenset(), inherit_mask):
+        if masked and node.mutations:
+            remaining_mutations = []
+            for m in node.mutations:
+                position = mutation_position(encode_mutation(m))
+                if position in masked:
+                    removed_counts[position] += 1
+                else:
+                    remaining_mutations.append(m)
+            metrics.count("masked_nodes_checked")
+            if len(remaining_mutations) < len(node.mutations):
+                nodes_updated += 1
+                node.update_mutations(remaining_mutations, update_branch_length=True)
+
+    return nodes_updated, dict(removed_counts)
+
+def mask_flat_tree(flat_tree, mask_dict):
+    """
+    The flattened tree after mask_mutations, derived from the arrays instead
+    of flattening the masked tree again: the mutations at the masked
+    positions in each masked node's subtree, excluding the node itself, are dropped.
+    """
+    keep = np.ones(len(flat_tree.mutation_node), dtype=bool)
+    for node_id, positions in mask_dict.items():
+        node = flat_tree.index[node_id]
+        lo, hi = flat_tree.mutation_offsets[flat_tree.subtree_start[node]], flat_tree.mutation_offsets[node]
+        keep[lo:hi] &= ~np.isin(flat_tree.mutation_position[lo:hi], positions)
+    mutation_node = flat_tree.mutation_node[keep]
+    branch_length = np.bincount(mutation_node, minlength=len(flat_tree)).astype(np.int32)
+    return FlatTree(flat_tree.ids, flat_tree.parent, flat_tree.child_offsets, flat_tree.children, mutation_node, flat_tree.mutation_code[keep], branch_length, flat_tree.max_branch_length, subtree_start=flat_tree.subtree_start)
 
 def main():
     args = parse_args()
-    tree = bte.MATree(args.input_tree)
+    configure_metrics(args)
+    with metrics.phase("load_tree"):
+        tree = bte.MATree(args.input_tree)
 
     # Get mutation counts
-    mutation_counts = get_mutation_counts(tree.root)
+    with metrics.phase("flatten"):
+        flat_tree = FlatTree.from_bte(tree)
+    mutation_counts = get_mutation_counts(flat_tree)
 
     print("Counting mutations", file=sys.stderr)
     total_mutations = sum(mutation_counts.values())
@@ -150,66 +287,66 @@ def main():
     # Prune mutations with fewer occurrences than the minimum count
     mutation_counts = {k: v for k, v in mutation_counts.items() if v >= args.min_count}
 
-    ## iteratively check for unbalanced splits
-    iteration = 1
-    while len(mutation_counts.keys()) > 0 :
-        print(f"Finding splits. Iteration no: {iteration}", file=sys.stderr)
-    
-        # Use Manager to create shared data structures
-        manager = Manager()
-        mask_dict = manager.dict()  # Shared dictionary for storing mutations and node_ids
-        chi_list = manager.list()  # Shared list for storing chi results
-
-        # Limit the number of concurrent processes
-        processes = []
-        for position, count in mutation_counts.items():
-
-            print(f"\tPosition: {position}\tOccurrences: {count}", file=sys.stderr)
-            
-            # Start a new process for each mutation
-            p = run_in_process(tree, position, count, total_mutations, args, mask_dict, chi_list)
-            processes.append(p)
-            
-            # Ensure we don't exceed the specified number of threads
-            if len(processes) >= args.nthreads:
-                for proc in processes:
-                    proc.join()
-                processes = []  # Reset the list after joining
-
-        # Wait for remaining processes to finish
-        for proc in processes:
-            proc.join()
-
-        # Print mutations with chi-square values exceeding mask_chi
-        print(f"Mutations checked: ", file=sys.stderr)
-        for position, chi, node_id in sorted(chi_list, key=lambda x: -x[1]):
-            print(f"{position}\t{chi}\t{node_id}", file=sys.stderr)
+    # one pool for all iterations; each iteration's tree is handed to it through memory mapped arrays
+    state_dir = tempfile.mkdtemp(prefix="mask_site_splits.")
+    pool = start_pool(args.nthreads, state_dir, total_mutations, args.min_total)
+
+    # the pool and the memory mapped trees are cleaned up however the loop ends
+    try:
+        ## iteratively check for unbalanced splits
+        iteration = 1
+        while len(mutation_counts.keys()) > 0 :
+            print(f"Finding splits. Iteration no: {iteration}", file=sys.stderr)
+
+            for position, count in mutation_counts.items():
+                print(f"\tPosition: {position}\tOccurrences: {count}", file=sys.stderr)
+
+            with metrics.phase("scan"):
+                write_generation(flat_tree, state_dir, iteration)
+                positions = sorted(mutation_counts, key=lambda position: -mutation_counts[position])
+                chi_list = scan_positions(pool, iteration, positions)
+            mask_dict = find_site_splits(chi_list, args)
+            shutil.rmtree(generation_path(state_dir, iteration - 1), ignore_errors=True)
+
+            # Print mutations with chi-square values exceeding mask_chi
+            print(f"Mutations checked: ", file=sys.stderr)
+            for position, chi, node_id in sorted(chi_list, key=lambda x: -x[1]):
+                print(f"{position}\t{chi}\t{node_id}", file=sys.stderr)
         
-        # Mask mutations if mask_chi is greater than 0
-        if args.mask_chi > 0 and len( mask_dict.keys() ) > 0 :
-            print("Masking mutations: ", len(mask_dict.keys()), file=sys.stderr)
-            mask_mutations(tree.root, mask_dict)
-        
-            print("Recounting mutations", file=sys.stderr)
-            mutation_counts = get_mutation_counts(tree.root)
-
-            # Flatten the mutation positions from mask_dict into a single set for faster lookup
-            masked_positions = set(pos for mutations in mask_dict.values() for pos in mutations)
-
-            # Filter mutation_counts based on whether they are present in the flattened mask positions
-            filtered_counts = {k: v for k, v in mutation_counts.items() if k in masked_positions}
-
-            print("Filtered mutation counts:", filtered_counts, file=sys.stderr)
-            print("Sites to recheck: ", len(filtered_counts.keys()), file=sys.stderr)
-            mutation_counts = filtered_counts
-
-        else :
-            mutation_counts = {}
-
-        iteration += 1
+            # Mask mutations if mask_chi is greater than 0
+            if args.mask_chi > 0 and len( mask_dict.keys() ) > 0 :
+                print("Masking mutations: ", len(mask_dict.keys()), file=sys.stderr)
+                with metrics.phase("mask"):
+                    nodes_updated, removed_counts = mask_mutations(tree.root, mask_dict)
+                print(f"Removed {sum(removed_counts.values())} mutations from {nodes_updated} nodes", file=sys.stderr)
+
+                # Only the masked positions are rechecked, so their counts follow from what was removed
+                print("Recounting mutations", file=sys.stderr)
+                with metrics.phase("mask"):
+                    flat_tree = mask_flat_tree(flat_tree, mask_dict)
+                masked_positions = sorted(set(pos for mutations in mask_dict.values() for pos in mutations))
+                filtered_counts = {k: mutation_counts[k] - removed_counts.get(k, 0) for k in masked_positions}
+                filtered_counts = {k: v for k, v in filtered_counts.items() if v > 0}
+
+                print("Filtered mutation counts:", filtered_counts, file=sys.stderr)
+                print("Sites to recheck: ", len(filtered_counts.keys()), file=sys.stderr)
+                mutation_counts = filtered_counts
+
+            else :
+                mutation_counts = {}
+
+            iteration += 1
+
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        shutil.rmtree(state_dir, ignore_errors=True)
 
     print("Saving tree to: ", args.output_tree, file=sys.stderr)
-    tree.save_pb(args.output_tree)  # Use the BTE library's method to save the modified tree
+    with metrics.phase("write_output"):
+        tree.save_pb(args.output_tree)  # Use the BTE library's method to save the modified tree
+    finish_metrics(args)
 
 if __name__ == "__main__":
     main()
@@ -1,88 +1,86 @@
 import bte
+import os
 import sys
 import argparse
 import numpy as np
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spectrumSplits"))
+from flat_tree import FlatTree
+from metrics import metrics, add_metrics_args, configure_metrics, finish_metrics
+
 # Command-line argument parsing
 def parse_args():
     parser = argparse.ArgumentParser(description="Process a phylogenetic tree for changepoint detection in mutation/descendant ratios.")
     parser.add_argument("--input_tree", type=str, default="public-2024-08-06.masked.pb.gz", help="Input tree file (protobuf format)")
     parser.add_argument("--output_tree", type=str, default="pruned_tree.pb.gz", help="Output tree file (protobuf format)")
     parser.add_argument("--threshold", type=float, default=0, help="Mutation:Leaf Ratio to prune")
+    add_metrics_args(parser)
     return parser.parse_args()
 
-# Compute the mutation-to-descendant ratio for each node and store it
-def compute_descendants_mutations_ratio(node, mutation_ratio):
-    if not node.children:  # Base case: If node is a tip (no children)
-        mutation_ratio[node.id] = len(node.mutations) / 1  # 1 because it's a tip itself
-        return 1, len(node.mutations), [node.id]  # Return the tip count and mutations
-
-    total_tips = 0
-    total_mutations = len(node.mutations)
-    descendant_tips = []
-
-    for child in node.children:  # Recursive case
-        child_tips, child_mutations, child_descendant_tips = compute_descendants_mutations_ratio(child, mutation_ratio)
-        total_tips += child_tips
-        total_mutations += child_mutations
-        descendant_tips.extend(child_descendant_tips)
-
-    ratio = total_mutations / total_tips if total_tips > 0 else float('inf')
-    mutation_ratio[node.id] = ratio
-
-    return total_tips, total_mutations, descendant_tips
-
-# Traverse the tree and detect changepoints based on mutation/descendant ratio changes
-def detect_changepoints(node, mutation_ratio, threshold, changepoints, to_prune):
-    for child in node.children:
-        if mutation_ratio[child.id] >= threshold:
-            changepoints.append((node.id, child.id, mutation_ratio[child.id], child))
-            to_prune.add(child)
+# Compute the mutation-to-descendant ratio for each node, in postorder
+def compute_descendants_mutations_ratio(flat_tree):
+    # tip and mutation totals of every subtree, from postorder cumulative sums
+    total_tips = flat_tree.subtree_sums(flat_tree.is_leaf.astype(np.int64))
+    total_mutations = flat_tree.subtree_sums(np.asarray(flat_tree.branch_length))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total_tips > 0, total_mutations / total_tips, float('inf'))
+
+# Traverse the tree and yield the (parent, child) changepoints based on mutation/descendant ratio changes, in preorder
+def detect_changepoints(flat_tree, mutation_ratio, threshold):
+    stack = list(reversed(flat_tree.node_children(flat_tree.root).tolist()))
+    while stack:
+        child = stack.pop()
+        if mutation_ratio[child] >= threshold:
+            yield int(flat_tree.parent[child]), child
             continue
-        detect_changepoints(child, mutation_ratio, threshold, changepoints, to_prune)
+        stack.extend(reversed(flat_tree.node_children(child).tolist()))
 
 # Determine the threshold based on the overall distribution of ratios
 def compute_threshold(mutation_ratios):
-    ratios = np.array(list(mutation_ratios.values()))
-    return np.mean(ratios) + np.std(ratios) * 2
+    return np.mean(mutation_ratios) + np.std(mutation_ratios) * 2
 
 # Function to prune marked nodes from the tree
 def prune_tree(tree, to_prune):
-    for node in to_prune:
-        tree.remove_node(node.id)
-
-# Helper function to get all descendant tips of a node
-def get_descendant_tips(node):
-    if not node.children:  # Base case: If node is a tip
-        return [node.id]
+    for node_id in to_prune:
+        tree.remove_node(node_id)
 
-    tips = []
-    for child in node.children:
-        tips.extend(get_descendant_tips(child))
-    return tips
+# The tips of every clade are a contiguous range of the tree's tips in left-to-right order
+def tip_ranges(flat_tree):
+    tip_order = np.nonzero(flat_tree.is_leaf)[0]
+    first_tip = np.searchsorted(tip_order, flat_tree.subtree_start)
+    end_tip = np.searchsorted(tip_order, np.arange(len(flat_tree)), side="right")
+    return tip_order, first_tip, end_tip
 
 def main():
     args = parse_args()
-    tree = bte.MATree(args.input_tree)
+    configure_metrics(args)
+    with metrics.phase("load_tree"):
+        tree = bte.MATree(args.input_tree)
+    with metrics.phase("flatten"):
+        flat_tree = FlatTree.from_bte(tree)
 
-    mutation_ratio = {}
-    compute_descendants_mutations_ratio(tree.root, mutation_ratio)
+    with metrics.phase("mutation_ratio"):
+        mutation_ratio = compute_descendants_mutations_ratio(flat_tree)
+    metrics.count("nodes_visited", len(flat_tree))
 
     if args.threshold == 0:
         args.threshold = compute_threshold(mutation_ratio)
 
-    changepoints = []
-    to_prune = set()
-    detect_changepoints(tree.root, mutation_ratio, args.threshold, changepoints, to_prune)
-
-    print("#Parent\tchild\ttips\tmutations:tips")
-    for parent_id, child_id, ratio, child_node in changepoints:
-        descendant_tips = get_descendant_tips(child_node)
-        tips_str = ",".join(descendant_tips) if descendant_tips else ""
-        print(f"{parent_id}\t{child_id}\t{tips_str}\t{ratio}")
-
-    prune_tree(tree, to_prune)
-    tree.save_pb(args.output_tree)
+    # write each changepoint as it is found rather than collecting them all
+    with metrics.phase("changepoints"):
+        tip_order, first_tip, end_tip = tip_ranges(flat_tree)
+        to_prune = []
+        print("#Parent\tchild\ttips\tmutations:tips")
+        for parent, child in detect_changepoints(flat_tree, mutation_ratio, args.threshold):
+            tips_str = ",".join(flat_tree.ids[tip] for tip in tip_order[first_tip[child]:end_tip[child]].tolist())
+            print(f"{flat_tree.ids[parent]}\t{flat_tree.ids[child]}\t{tips_str}\t{mutation_ratio[child]}")
+            to_prune.append(flat_tree.ids[child])
+    metrics.count("changepoints", len(to_prune))
+
+    with metrics.phase("write_output"):
+        prune_tree(tree, to_prune)
+        tree.save_pb(args.output_tree)
+    finish_metrics(args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,279 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import numpy as np
+from tree_cache import load_flat_tree
+from bootstrap_store import BootstrapStoreWriter, STORE_KINDS, store_chunks
+from spectrumSplits import run_bootstrap, run_bootstrap_spectra, write_spectra_to_tsv, partition_tips
+from metrics import metrics, add_metrics_args, configure_metrics, finish_metrics
+
+# A bootstrap queue is a directory shared by every host of a run:
+#   queue.json  the tree, thresholds, master seed and splits of the run
+#   pending/    one empty file per task, named <kind>-<first>-<last>
+#   claimed/    tasks being worked on, renamed to <task>.<host>.<pid>
+#   done/       finished tasks, under the name they were claimed with
+#   failed/     replicates (<kind>-<n>-<n>) or whole tasks that raised, holding the error
+#   store/      a bootstrap store every worker appends one chunk per task to
+# Claiming a task is a rename out of pending/, which only one worker can win,
+# so no coordinator or lock is needed. Every replicate draws from its own
+# random stream (see replicate_rng), so a task gives the same result on any
+# host and a task run twice, after its claim was requeued, is harmless:
+# merge keeps one copy of each replicate. For the same reason a replicate
+# that fails fails everywhere, so it is recorded in failed/ and never
+# retried.
+QUEUE_VERSION = 1
+
+# Command-line argument parsing
+def parse_args():
+    parser = argparse.ArgumentParser(description="Spread spectrumSplits.py bootstrap replicates over several hosts through a shared queue directory.")
+    parser.add_argument("command", choices=["submit", "work", "status", "merge"], help="Create the queue, work through its tasks, report progress, or write the merged results")
+    parser.add_argument("--queue", type=str, required=True, help="Queue directory, on a file system shared by all hosts")
+    parser.add_argument("--input_tree", type=str, default=None, help="Input tree file (protobuf format); workers and merge default to the path given to submit")
+    parser.add_argument("--tree_cache", type=str, nargs="?", const="", default=None, help="Load the tree through an on-disk cache, rebuilt when the input changes (optionally give the cache directory)")
+    parser.add_argument("--spectrum_file", type=str, default="spectra_output.tsv", help="submit: spectrumSplits.py output whose splits the spectrum bootstrap resamples")
+    parser.add_argument("--bootstrap_splits", type=int, default=0, help="submit: Number of bootstrap replicates to attempt in defining splits")
+    parser.add_argument("--bootstrap_spectra", type=int, default=0, help="submit: Number of bootstrap replicates to attempt in defining spectra")
+    parser.add_argument("--task_size", type=int, default=10, help="submit: Replicates per task")
+    parser.add_argument("--seed", type=int, default=None, help="submit: Master seed of the bootstrap replicates (random if not given)")
+    parser.add_argument("--min_chi", type=float, default=500, help="submit: Minimum Chi-square value to accept a split")
+    parser.add_argument("--min_mutations", type=int, default=500, help="submit: Minimum number of mutations required for a split")
+    parser.add_argument("--max_branch_length", type=int, default=100000, help="submit: Maximum branch length to include in spectrum calculations")
+    parser.add_argument("--nthreads", type=int, default=1, help="work: Number of processes for the split bootstrap replicates of a task")
+    parser.add_argument("--requeue_after", type=float, default=None, help="work: Once no task is pending, put back claims older than this many seconds (their worker is assumed dead)")
+    parser.add_argument("--output_dir", type=str, default=".", help="merge: Directory for the bootstrap_<n>_<kind>_output.tsv files")
+    parser.add_argument("--bootstrap_store", type=str, default=None, help="merge: Write a single store with one copy of every replicate instead of TSV files")
+    add_metrics_args(parser)
+    return parser.parse_args()
+
+def queue_dirs(queue):
+    return {name: os.path.join(queue, name) for name in ("pending", "claimed", "done", "failed", "store")}
+
+def task_name(kind, first, last):
+    return f"{kind}-{first:08d}-{last:08d}"
+
+def task_replicates(name):
+    """Kind and replicates of a task from its (possibly claimed) file name."""
+    kind, first, last = name.split(".")[0].split("-")
+    return kind, list(range(int(first), int(last) + 1))
+
+def read_queue(queue):
+    with open(os.path.join(queue, "queue.json")) as f:
+        config = json.load(f)
+    if config.get("version") != QUEUE_VERSION:
+        raise ValueError(f"queue {queue} has version {config.get('version')}, expected {QUEUE_VERSION}")
+    return config
+
+def read_split_ids(spectrum_file):
+    with open(spectrum_file) as f:
+        return [line.split("\t")[0] for line in f.read().splitlines()[1:] if line]
+
+def submit(args):
+    if os.path.exists(os.path.join(args.queue, "queue.json")):
+        raise ValueError(f"{args.queue} already holds a queue")
+    if args.bootstrap_spectra > 0 and not os.path.exists(args.spectrum_file):
+        raise FileNotFoundError(f"{args.spectrum_file} does not exist; run spectrumSplits.py first or give --spectrum_file")
+    flat_tree = load_flat_tree(args.input_tree, args.tree_cache, args.max_branch_length)
+    seed = args.seed if args.seed is not None else np.random.SeedSequence().entropy
+    config = {
+        "version": QUEUE_VERSION,
+        "input_tree": os.path.abspath(args.input_tree),
+        "nodes": len(flat_tree),
+        "mutations": len(flat_tree.mutation_node),
+        "max_branch_length": args.max_branch_length,
+        "min_chi": args.min_chi,
+        "min_mutations": args.min_mutations,
+        "seed": seed,
+        "replicates": {"splits": args.bootstrap_splits, "spectra": args.bootstrap_spectra},
+        "splits": read_split_ids(args.spectrum_file) if args.bootstrap_spectra > 0 else [],
+    }
+    dirs = queue_dirs(args.queue)
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+    ntasks = 0
+    for kind in STORE_KINDS:
+        for first in range(1, config["replicates"][kind] + 1, args.task_size):
+            last = min(first + args.task_size - 1, config["replicates"][kind])
+            open(os.path.join(dirs["pending"], task_name(kind, first, last)), "w").close()
+            ntasks += 1
+    # written last, so workers never start on a half-built queue
+    with open(os.path.join(args.queue, "queue.json"), "w") as f:
+        json.dump(config, f, indent=2)
+    print(f"Queued {ntasks} tasks in {args.queue} with seed {seed}", file=sys.stderr)
+
+def record_failure(dirs, kind, first, last, error):
+    with open(os.path.join(dirs["failed"], task_name(kind, first, last)), "w") as f:
+        f.write(error + "\n")
+
+def failed_replicates(dirs, kind):
+    """replicate -> error of the replicates of a kind recorded as failed, alone or with their whole task."""
+    failed = {}
+    if not os.path.isdir(dirs["failed"]):
+        return failed
+    for name in sorted(os.listdir(dirs["failed"])):
+        failed_kind, replicates = task_replicates(name)
+        if failed_kind == kind:
+            with open(os.path.join(dirs["failed"], name)) as f:
+                error = f.read().strip()
+            failed.update((replicate, error) for replicate in replicates)
+    return failed
+
+def claim_task(dirs, worker):
+    """Move one pending task to claimed/ and return its claimed path, or None when none is left."""
+    for name in sorted(os.listdir(dirs["pending"])):
+        claimed_path = os.path.join(dirs["claimed"], f"{name}.{worker}")
+        try:
+            os.rename(os.path.join(dirs["pending"], name), claimed_path)
+        except FileNotFoundError:
+            # another worker got there first
+            continue
+        # the claim's age is what requeue_stale looks at
+        os.utime(claimed_path)
+        return claimed_path
+    return None
+
+def requeue_stale(dirs, max_age):
+    requeued = 0
+    for name in os.listdir(dirs["claimed"]):
+        claimed_path = os.path.join(dirs["claimed"], name)
+        try:
+            if time.time() - os.path.getmtime(claimed_path) < max_age:
+                continue
+            os.rename(claimed_path, os.path.join(dirs["pending"], name.split(".")[0]))
+        except FileNotFoundError:
+            continue
+        print(f"Requeued stale task {name}", file=sys.stderr)
+        requeued += 1
+    metrics.count("tasks_requeued", requeued)
+    return requeued
+
+def load_queue_tree(args, config):
+    """The queue's tree, refusing one that differs from the tree the queue was submitted with."""
+    flat_tree = load_flat_tree(args.input_tree or config["input_tree"], args.tree_cache, config["max_branch_length"])
+    if (len(flat_tree), len(flat_tree.mutation_node)) != (config["nodes"], config["mutations"]):
+        raise ValueError(f"tree has {len(flat_tree)} nodes and {len(flat_tree.mutation_node)} mutations, but the queue was submitted with {config['nodes']} and {config['mutations']}")
+    return flat_tree
+
+def work(args):
+    config = read_queue(args.queue)
+    dirs = queue_dirs(args.queue)
+    with metrics.phase("load_tree"):
+        flat_tree = load_queue_tree(args, config)
+    splits = {flat_tree.index[node_id] for node_id in config["splits"]}
+    # queues submitted before failures were recorded have no failed/ directory
+    os.makedirs(dirs["failed"], exist_ok=True)
+    worker = f"{socket.gethostname()}.{os.getpid()}"
+    ntasks = 0
+    while True:
+        claimed_path = claim_task(dirs, worker)
+        if claimed_path is None and args.requeue_after is not None and requeue_stale(dirs, args.requeue_after):
+            continue
+        if claimed_path is None:
+            break
+        name = os.path.basename(claimed_path)
+        kind, replicates = task_replicates(name)
+        print(f"Worker {worker} running task {name.split('.')[0]}", file=sys.stderr)
+        # the whole task goes into one chunk, written when it finishes
+        try:
+            with metrics.phase(f"bootstrap_{kind}"), BootstrapStoreWriter(dirs["store"], kind, chunk_size=len(replicates)) as store:
+                if kind == "splits":
+                    failed = run_bootstrap(flat_tree, replicates, args.nthreads, config["min_chi"], config["min_mutations"], store, config["seed"])
+                else:
+                    failed = {}
+                    run_bootstrap_spectra(flat_tree, replicates, splits, store=store, seed=config["seed"])
+        except Exception as e:
+            # the seeds make it fail the same way on every host, so requeueing it would only move the failure around
+            error = f"{type(e).__name__}: {e}"
+            print(f"Task {name} failed: {error}", file=sys.stderr)
+            record_failure(dirs, kind, replicates[0], replicates[-1], error)
+            metrics.count("tasks_failed")
+        else:
+            for replicate, error in failed.items():
+                record_failure(dirs, kind, replicate, replicate, error)
+            metrics.count("tasks_done")
+        try:
+            os.rename(claimed_path, os.path.join(dirs["done"], name))
+        except FileNotFoundError:
+            # requeued while we worked; its results are in the store all the same and merge drops the copy
+            print(f"Task {name} was requeued before it finished", file=sys.stderr)
+        ntasks += 1
+    print(f"Worker {worker} finished {ntasks} tasks, none left pending", file=sys.stderr)
+
+def status(args):
+    config = read_queue(args.queue)
+    dirs = queue_dirs(args.queue)
+    tasks = {state: sorted(os.listdir(dirs[state])) for state in ("pending", "claimed", "done")}
+    print(f"seed\t{config['seed']}")
+    for state, names in tasks.items():
+        print(f"{state}\t{len(names)}")
+    for name in tasks["claimed"]:
+        print(f"claimed\t{name}\t{time.time() - os.path.getmtime(os.path.join(dirs['claimed'], name)):.0f}s")
+    for kind in STORE_KINDS:
+        stored = collect_replicates(dirs["store"], kind)
+        failed = {replicate: error for replicate, error in failed_replicates(dirs, kind).items() if replicate not in stored}
+        print(f"{kind}\t{len(stored)}/{config['replicates'][kind]} replicates stored, {len(failed)} failed")
+        for replicate, error in sorted(failed.items()):
+            print(f"failed\t{kind}\t{replicate}\t{error}")
+
+def collect_replicates(store_path, kind):
+    """replicate -> (node ids, counts) of a kind in a store, taking each replicate from the first chunk that holds it."""
+    replicates = {}
+    for chunk in store_chunks(store_path, kind):
+        with np.load(chunk) as data:
+            chunk_replicates = data["replicate"]
+            for replicate in np.unique(chunk_replicates).tolist():
+                if replicate not in replicates:
+                    rows = chunk_replicates == replicate
+                    replicates[replicate] = (data["node_id"][rows], data["counts"][rows])
+    return replicates
+
+def merge(args):
+    config = read_queue(args.queue)
+    dirs = queue_dirs(args.queue)
+    with metrics.phase("load_tree"):
+        flat_tree = load_queue_tree(args, config)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for kind in STORE_KINDS:
+        replicates = collect_replicates(dirs["store"], kind)
+        failed = {replicate: error for replicate, error in failed_replicates(dirs, kind).items() if replicate not in replicates}
+        for replicate, error in sorted(failed.items()):
+            print(f"Warning: {kind} bootstrap replicate {replicate} failed and is left out: {error}", file=sys.stderr)
+        missing = sorted(set(range(1, config["replicates"][kind] + 1)) - set(replicates) - set(failed))
+        if missing:
+            print(f"Warning: {len(missing)} {kind} bootstrap replicates are not done yet, first missing is {missing[0]}", file=sys.stderr)
+        tip_partition = None
+        if kind == "spectra" and replicates:
+            # every spectrum replicate shares the run's splits
+            tip_partition = partition_tips(flat_tree, np.array(sorted(flat_tree.index[node_id] for node_id in config["splits"]), dtype=np.int64))
+        with metrics.phase("write_output"):
+            store = BootstrapStoreWriter(args.bootstrap_store, kind) if args.bootstrap_store is not None else None
+            for replicate in sorted(replicates):
+                node_ids, counts = replicates[replicate]
+                spectra = {flat_tree.index[node_id]: spectrum for node_id, spectrum in zip(node_ids.tolist(), counts)}
+                if store is not None:
+                    store.add(flat_tree, replicate, spectra)
+                else:
+                    write_spectra_to_tsv(flat_tree, spectra, os.path.join(args.output_dir, f"bootstrap_{replicate}_{kind}_output.tsv"), 0, tip_partition)
+            if store is not None:
+                store.flush()
+        print(f"Merged {len(replicates)} {kind} bootstrap replicates, {len(failed)} failed", file=sys.stderr)
+
+def main():
+    args = parse_args()
+    configure_metrics(args)
+    if args.command == "submit":
+        if args.input_tree is None:
+            raise ValueError("submit needs --input_tree")
+        submit(args)
+    elif args.command == "work":
+        work(args)
+    elif args.command == "status":
+        status(args)
+    else:
+        merge(args)
+    finish_metrics(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import os
+import uuid
+import numpy as np
+
+# A bootstrap store is a directory of compressed .npz chunks. Each chunk holds
+# the rows of one or more replicates in long format, one row per split:
+#   replicate  int32
+#   node_id    unicode
+#   counts     N x 12 int64 mutation type counts of the split's region
+#   spectrum   N x 12 float64 normalized spectrum
+# Chunk names start with the kind of bootstrap ("splits" or "spectra").
+# Chunks are written to a hidden temporary file and renamed into place, so
+# any number of writers can add to the same store without locking, and
+# readers never see a partial chunk.
+STORE_KINDS = ("splits", "spectra")
+
+class BootstrapStoreWriter:
+    """Buffers replicate results and appends them to a store chunk_size replicates at a time."""
+
+    def __init__(self, path, kind, chunk_size=100):
+        if kind not in STORE_KINDS:
+            raise ValueError(f"unknown bootstrap kind {kind}, expected one of {STORE_KINDS}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.kind = kind
+        self.chunk_size = chunk_size
+        self.rows = []
+
+    def add(self, flat_tree, replicate, spectra_dict):
+        """Queue the spectra (node -> 12 counts) of one replicate."""
+        nodes = list(spectra_dict.keys())
+        counts = np.array([spectra_dict[node] for node in nodes], dtype=np.int64).reshape(len(nodes), 12)
+        self.rows.append((replicate, [flat_tree.ids[node] for node in nodes], counts))
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        replicates = np.concatenate([np.full(len(node_ids), replicate, dtype=np.int32) for replicate, node_ids, counts in self.rows])
+        node_ids = np.array([node_id for replicate, ids, counts in self.rows for node_id in ids], dtype=str)
+        counts = np.concatenate([counts for replicate, ids, counts in self.rows])
+        totals = counts.sum(axis=1, keepdims=True)
+        if np.any(totals == 0):
+            raise ValueError("Cannot normalize because the total sum of values is 0.")
+
+        name = f"{self.kind}-{int(replicates[0]):08d}-{uuid.uuid4().hex}.npz"
+        staging_path = os.path.join(self.path, f".{name}.tmp")
+        with open(staging_path, "wb") as f:
+            np.savez_compressed(f, replicate=replicates, node_id=node_ids, counts=counts, spectrum=counts / totals)
+        os.replace(staging_path, os.path.join(self.path, name))
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+def store_chunks(path, kind):
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.startswith(f"{kind}-") and name.endswith(".npz"))
+
+def read_bootstrap_store(path, kind):
+    """
+    All rows of one kind of bootstrap in a store as a dict of columns
+    (replicate, node_id, counts, spectrum), ordered by replicate.
+    """
+    columns = {"replicate": [], "node_id": [], "counts": [], "spectrum": []}
+    for chunk in store_chunks(path, kind):
+        with np.load(chunk) as data:
+            for name in columns:
+                columns[name].append(data[name])
+    if not columns["replicate"]:
+        return {"replicate": np.zeros(0, dtype=np.int32), "node_id": np.zeros(0, dtype=str), "counts": np.zeros((0, 12), dtype=np.int64), "spectrum": np.zeros((0, 12))}
+    columns = {name: np.concatenate(values) for name, values in columns.items()}
+    order = np.argsort(columns["replicate"], kind="stable")
+    return {name: values[order] for name, values in columns.items()}
+
+def stored_replicates(path, kind):
+    """Replicates of one kind already in a store; a missing store holds none."""
+    if not os.path.isdir(path):
+        return set()
+    replicates = set()
+    for chunk in store_chunks(path, kind):
+        with np.load(chunk) as data:
+            replicates.update(np.unique(data["replicate"]).tolist())
+    return replicates
@@ -0,0 +1,44 @@
+import os
+import json
+
+### bump whenever the layout or meaning of the checkpoint changes
+CHECKPOINT_VERSION = 1
+
+# A checkpoint is a small JSON file describing where a run got to: the run's
+# settings (so a resume against a different tree or different thresholds is
+# refused), the split node ids accepted and finalized so far by
+# find_splits, and the master seed of the run's bootstrap replicates, so a
+# resumed run draws the rest of its replicates from the same seed. It is rewritten after every iteration through a temporary file
+# and a rename, so a run killed at any point leaves the previous one intact.
+
+def write_checkpoint(path, settings, accepted_ids, finalized_ids, seed=None):
+    checkpoint = {
+        "version": CHECKPOINT_VERSION,
+        "settings": settings,
+        "accepted": sorted(accepted_ids),
+        "finalized": sorted(finalized_ids),
+        "complete": len(accepted_ids) == len(finalized_ids),
+        "seed": seed,
+    }
+    directory, name = os.path.split(os.path.abspath(path))
+    staging_path = os.path.join(directory, f".{name}.tmp{os.getpid()}")
+    with open(staging_path, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(staging_path, path)
+
+def read_checkpoint(path, settings):
+    """
+    The checkpoint at path, or None if there is none. Raises ValueError when
+    it was written by a run with other settings or another version.
+    """
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return None
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        raise ValueError(f"checkpoint {path} has version {checkpoint.get('version')}, expected {CHECKPOINT_VERSION}")
+    if checkpoint["settings"] != settings:
+        changed = sorted(key for key in set(settings) | set(checkpoint["settings"]) if settings.get(key) != checkpoint["settings"].get(key))
+        raise ValueError(f"checkpoint {path} was written by a run with different {', '.join(changed)}; remove it or run without --resume")
+    return checkpoint
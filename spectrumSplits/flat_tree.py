@@ -0,0 +1,189 @@
+import numpy as np
+from mutations import encode_mutation, decode_mutation, mutation_position, mutation_type
+from traversal import postorder
+
+class FlatTree:
+    """
+    Compact postorder representation of a mutation annotated tree.
+
+    Node i is the i-th node visited in a postorder traversal, so the subtree
+    of node i occupies the contiguous index range [subtree_start[i], i] and the
+    root is the last node. Mutations are stored as packed codes (see
+    mutations.py) with their positions and types unpacked alongside, and the
+    per-node mutation type counts are kept in an N x 12 matrix with branches
+    longer than max_branch_length already masked out.
+    """
+
+    def __init__(self, ids, parent, child_offsets, children, mutation_node, mutation_code, branch_length, max_branch_length=100000, subtree_start=None):
+        self.ids = ids
+        self.index = {node_id: i for i, node_id in enumerate(ids)}
+        self.parent = parent
+        self.child_offsets = child_offsets
+        self.children = children
+        self.mutation_node = mutation_node
+        self.mutation_code = mutation_code
+        self.mutation_position = mutation_position(np.asarray(mutation_code)).astype(np.int32)
+        self.mutation_type = mutation_type(np.asarray(mutation_code))
+        self.branch_length = branch_length
+        self.max_branch_length = max_branch_length
+        self.subtree_start = self._compute_subtree_start() if subtree_start is None else subtree_start
+        # mutations are stored in postorder too, so each node's mutations are a contiguous range
+        self.mutation_offsets = np.searchsorted(mutation_node, np.arange(len(ids) + 1))
+        self.is_leaf = np.diff(child_offsets) == 0
+        self.counts = self.weighted_counts()
+
+    @classmethod
+    def from_bte(cls, tree, max_branch_length=100000):
+        """Flatten a bte.MATree with a single postorder traversal."""
+        ids = []
+        parent = []
+        child_lists = []
+        mutation_node = []
+        mutation_code = []
+        branch_length = []
+
+        # each finished subtree leaves its root on pending, so a node's children are the last entries there
+        pending = []
+        for node in postorder(tree.root):
+            index = len(ids)
+            ids.append(node.id)
+            parent.append(-1)
+            first = len(pending) - len(node.children)
+            emitted = pending[first:]
+            del pending[first:]
+            for child_index in emitted:
+                parent[child_index] = index
+            child_lists.append(emitted)
+            pending.append(index)
+
+            branch_length.append(len(node.mutations))
+            for mutation in node.mutations:
+                mutation_node.append(index)
+                mutation_code.append(encode_mutation(mutation))
+
+        child_offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        child_offsets[1:] = np.cumsum([len(c) for c in child_lists])
+        children = np.fromiter((c for cl in child_lists for c in cl), dtype=np.int32, count=int(child_offsets[-1]))
+
+        return cls(
+            ids,
+            np.array(parent, dtype=np.int32),
+            child_offsets,
+            children,
+            np.array(mutation_node, dtype=np.int32),
+            np.array(mutation_code, dtype=np.int64),
+            np.array(branch_length, dtype=np.int32),
+            max_branch_length,
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def root(self):
+        return len(self.ids) - 1
+
+    def _compute_subtree_start(self):
+        # in postorder a node's subtree starts where its first child's subtree starts
+        subtree_start = np.arange(len(self.ids), dtype=np.int32)
+        first_child = self.children[self.child_offsets[:-1][np.diff(self.child_offsets) > 0]]
+        internal = np.nonzero(np.diff(self.child_offsets) > 0)[0]
+        for node, child in zip(internal.tolist(), first_child.tolist()):
+            subtree_start[node] = subtree_start[child]
+        return subtree_start
+
+    def node_children(self, node):
+        return self.children[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+    def node_mutations(self, node):
+        """Mutation strings of a node, e.g. C241T, rebuilt from the arrays."""
+        return [decode_mutation(code) for code in self.mutation_code[self.mutation_offsets[node]:self.mutation_offsets[node + 1]].tolist()]
+
+    def region_owner(self, splits):
+        """
+        For every node, the position in the sorted array splits of the closest
+        split at or above it, or -1 for nodes above all splits.
+        """
+        owner = np.full(len(self.ids), -1, dtype=np.int32)
+        # ancestors come after their descendants in postorder, so walking backwards lets nested splits overwrite
+        for k in reversed(range(len(splits))):
+            owner[self.subtree_start[splits[k]]:splits[k] + 1] = k
+        return owner
+
+    def spectrum_mask(self):
+        """Mutations that count toward spectra: known type on a branch no longer than max_branch_length."""
+        return (self.mutation_type >= 0) & (self.branch_length[self.mutation_node] <= self.max_branch_length)
+
+    def weighted_counts(self, weights=None):
+        """
+        N x 12 mutation type counts per node. Without weights every mutation
+        counts once (uint32); with a position -> weight dict each mutation
+        counts its position's weight and positions absent from weights count 0.
+        """
+        mask = self.spectrum_mask()
+        cells = self.mutation_node[mask].astype(np.int64) * 12 + self.mutation_type[mask]
+        if weights is None:
+            counts = np.bincount(cells, minlength=len(self.ids) * 12).astype(np.uint32)
+        else:
+            weight_array = np.zeros(int(self.mutation_position.max(initial=0)) + 1, dtype=np.int64)
+            for position, weight in weights.items():
+                if position < len(weight_array):
+                    weight_array[position] = weight
+            counts = np.bincount(cells, weights=weight_array[self.mutation_position[mask]], minlength=len(self.ids) * 12).astype(np.int64)
+        return counts.reshape(len(self.ids), 12)
+
+    def subtree_sums(self, values):
+        """Sum of per-node values (1-D, or N x k) over every node's subtree, via a postorder cumulative sum."""
+        cumulative = np.zeros((len(self.ids) + 1,) + values.shape[1:], dtype=np.int64)
+        np.cumsum(values, axis=0, out=cumulative[1:])
+        return cumulative[1:] - cumulative[self.subtree_start]
+
+    def subtree_spectra(self, counts):
+        """Full subtree spectrum of every node."""
+        return self.subtree_sums(counts)
+
+class AncestorIndex:
+    """
+    Binary lifting table over a FlatTree: the depth of every node and its
+    2^k-th ancestors, which answers lowest common ancestor and path length
+    queries for whole arrays of node pairs in O(log depth) array steps.
+    """
+
+    def __init__(self, flat_tree):
+        parent = np.asarray(flat_tree.parent, dtype=np.int64)
+        # pointer jumping: after round k, ancestor[k] is the 2^k-th ancestor (or -1) and depth counts the hops taken so far
+        self.depth = (parent >= 0).astype(np.int64)
+        self.ancestors = [parent]
+        jump = parent
+        while np.any(jump >= 0):
+            has_jump = jump >= 0
+            self.depth[has_jump] += self.depth[jump[has_jump]]
+            jump = np.where(has_jump, jump[np.maximum(jump, 0)], -1)
+            self.ancestors.append(jump)
+
+    def lift(self, nodes, steps):
+        """Ancestor steps levels above each node."""
+        nodes = np.array(nodes, dtype=np.int64)
+        for k, ancestor in enumerate(self.ancestors):
+            move = (steps >> k) & 1 == 1
+            nodes[move] = ancestor[nodes[move]]
+        return nodes
+
+    def lca(self, a, b):
+        a = np.asarray(a, dtype=np.int64)
+        b = np.asarray(b, dtype=np.int64)
+        # bring the deeper node of each pair up to the other's depth, then lift both while their ancestors differ
+        swap = self.depth[a] < self.depth[b]
+        a, b = np.where(swap, b, a), np.where(swap, a, b)
+        a = self.lift(a, self.depth[a] - self.depth[b])
+        for ancestor in reversed(self.ancestors):
+            differ = (a != b) & (ancestor[a] != ancestor[b])
+            a = np.where(differ, ancestor[a], a)
+            b = np.where(differ, ancestor[b], b)
+        return np.where(a == b, a, self.ancestors[0][a])
+
+    def distance(self, a, b):
+        """Number of branches on the path between each pair of nodes."""
+        a = np.asarray(a, dtype=np.int64)
+        b = np.asarray(b, dtype=np.int64)
+        return self.depth[a] + self.depth[b] - 2 * self.depth[self.lca(a, b)]
@@ -0,0 +1,106 @@
+import sys
+import json
+import time
+import socket
+import cProfile
+import resource
+from contextlib import contextmanager
+from collections import defaultdict
+
+class Metrics:
+    """
+    Opt-in run metrics: wall and CPU time per phase, event counters, per
+    replicate bootstrap timings and peak RSS, written as one JSON report.
+    Recording is cheap and always on; nothing is written unless a script
+    is run with --metrics. One phase can be run under cProfile.
+
+    Pool workers record into their own copy; the scripts return their
+    counter deltas with each result and merge them with add_counts.
+    """
+
+    def __init__(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.phases = {}
+        self.counters = defaultdict(int)
+        self.replicates = []
+        self.profile_phase = None
+        self.profile_output = None
+        self.profiler = None
+
+    @contextmanager
+    def phase(self, name):
+        profiling = name == self.profile_phase
+        if profiling:
+            # a phase entered several times (one per replicate) accumulates into one profile
+            if self.profiler is None:
+                self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            entry = self.phases.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0})
+            entry["wall_seconds"] += time.perf_counter() - wall
+            entry["cpu_seconds"] += time.process_time() - cpu
+            entry["calls"] += 1
+            if profiling:
+                self.profiler.disable()
+
+    def count(self, name, n=1):
+        self.counters[name] += int(n)
+
+    def add_counts(self, counts):
+        for name, n in counts.items():
+            self.counters[name] += n
+
+    def snapshot(self):
+        return dict(self.counters)
+
+    def counts_since(self, snapshot):
+        return {name: n - snapshot.get(name, 0) for name, n in self.counters.items() if n != snapshot.get(name, 0)}
+
+    def replicate(self, kind, replicate, seconds):
+        self.replicates.append({"kind": kind, "replicate": replicate, "wall_seconds": seconds})
+
+    def report(self):
+        return {
+            "command": sys.argv,
+            "host": socket.gethostname(),
+            "wall_seconds": time.perf_counter() - self.start_wall,
+            "cpu_seconds": time.process_time() - self.start_cpu,
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "peak_rss_children_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            "phases": self.phases,
+            "counters": dict(self.counters),
+            "replicates": self.replicates,
+        }
+
+    def write_profile(self):
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile_output)
+            print(f"Profile of phase {self.profile_phase} written to {self.profile_output}", file=sys.stderr)
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        print(f"Metrics written to {path}", file=sys.stderr)
+
+### the run's metrics, shared by every module of the process
+metrics = Metrics()
+
+def add_metrics_args(parser):
+    parser.add_argument("--metrics", type=str, default=None, help="Write a JSON report of per-phase timings, counters and peak memory to this file")
+    parser.add_argument("--profile_phase", type=str, default=None, help="Run this phase under cProfile and write the stats next to the metrics report (or to <phase>.prof)")
+
+def configure_metrics(args):
+    if args.profile_phase is not None:
+        metrics.profile_phase = args.profile_phase
+        metrics.profile_output = f"{args.metrics}.{args.profile_phase}.prof" if args.metrics else f"{args.profile_phase}.prof"
+
+def finish_metrics(args):
+    metrics.write_profile()
+    if args.metrics is not None:
+        metrics.write(args.metrics)
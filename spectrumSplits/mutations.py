@@ -0,0 +1,41 @@
+import numpy as np
+
+### the twelve mutation types, in the column order used by spectrum count matrices
+MUTATION_TYPES = ["AC","AG","AT","CA","CG","CT","GA","GC","GT","TA","TC","TG"]
+MUTATION_INDEX = {mutation_type: i for i, mutation_type in enumerate(MUTATION_TYPES)}
+
+### type code stored for mutations that are not one of the twelve types (e.g. involving N)
+UNKNOWN_TYPE = 15
+
+# A mutation string such as C241T is packed into one int64:
+#   bits 20+   position
+#   bits 12-19 reference base (ASCII)
+#   bits 4-11  alternate base (ASCII)
+#   bits 0-3   mutation type index, or UNKNOWN_TYPE
+POSITION_SHIFT = 20
+
+def encode_mutation(mutation):
+    ref = mutation[0]
+    alt = mutation[-1]
+    return (int(mutation[1:-1]) << POSITION_SHIFT) | (ord(ref) << 12) | (ord(alt) << 4) | MUTATION_INDEX.get(ref + alt, UNKNOWN_TYPE)
+
+def decode_mutation(code):
+    return f"{chr(mutation_ref(code))}{mutation_position(code)}{chr(mutation_alt(code))}"
+
+# The accessors below work on a single code or on an array of codes.
+def mutation_position(codes):
+    return codes >> POSITION_SHIFT
+
+def mutation_ref(codes):
+    return (codes >> 12) & 0xFF
+
+def mutation_alt(codes):
+    return (codes >> 4) & 0xFF
+
+def mutation_type(codes):
+    """Mutation type index into MUTATION_TYPES, or -1 for unknown types."""
+    if isinstance(codes, np.ndarray):
+        types = (codes & 0xF).astype(np.int8)
+        types[types == UNKNOWN_TYPE] = -1
+        return types
+    return -1 if codes & 0xF == UNKNOWN_TYPE else codes & 0xF
@@ -1,13 +1,20 @@
-import bte
+import os
 import sys
 import copy
 import csv 
-import random
 import argparse
-import random
-from multiprocessing import Process
+import gc
+import time
+import multiprocessing
+import numpy as np
 from collections import defaultdict
-from scipy.stats import chi2_contingency
+from scipy import sparse
+from mutations import MUTATION_TYPES
+from tree_cache import load_flat_tree
+from bootstrap_store import BootstrapStoreWriter, stored_replicates, STORE_KINDS
+from checkpoint import write_checkpoint, read_checkpoint
+from warm_start import write_state, read_state, map_splits, write_warm_report
+from metrics import metrics, add_metrics_args, configure_metrics, finish_metrics
 
 # Command-line argument parsing
 def parse_args():
@@ -19,55 +26,77 @@ def parse_args():
     parser.add_argument("--ntips", type=int, default=5, help="Number of tips to retrieve for each split")
     parser.add_argument("--bootstrap_splits", type=int, default=0, help="Number of bootstrap replicates to attempt in defining splits")
     parser.add_argument("--bootstrap_spectra", type=int, default=0, help="Number of bootstrap replicates to attempt in defining spectra")
-    parser.add_argument("--nthreads", type=int, default=1, help="Number of threads for concurrent bootstrapping")
+    parser.add_argument("--nthreads", type=int, default=1, help="Number of processes for concurrent bootstrapping and for scoring split regions")
     parser.add_argument("--max_branch_length", type=int, default=100000, help="Maximum branch length to include in spectrum calculations")
+    parser.add_argument("--bootstrap_store", type=str, default=None, help="Append bootstrap results to this compressed store directory instead of writing one TSV per replicate")
+    parser.add_argument("--tree_cache", type=str, nargs="?", const="", default=None, help="Load the tree through an on-disk cache, rebuilt when the input changes (optionally give the cache directory)")
+    parser.add_argument("--seed", type=int, default=None, help="Master seed of the bootstrap replicates, each of which draws from its own stream derived from the seed and its number (random if not given)")
+    parser.add_argument("--checkpoint", type=str, default=None, help="Checkpoint the split search to this file after every iteration (with --resume alone, <output_spectrum>.checkpoint.json)")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run from its checkpoint and skip the bootstrap replicates already written")
+    parser.add_argument("--save_state", type=str, default=None, help="Write the splits and region spectra of this run to this file, for a later --warm_start")
+    parser.add_argument("--warm_start", type=str, default=None, help="Start the split search from the state saved by a run on an earlier release of the tree, re-evaluating only the regions that changed")
+    parser.add_argument("--warm_tolerance", type=float, default=0.01, help="Largest change of a region's mutation type counts, as a fraction of its previous total, for which the region is kept without re-evaluation")
+    add_metrics_args(parser)
     return parser.parse_args()
 
-### mutation positions 
-def get_positions( node ) :
-    positions = set() 
-    for mutation in node.mutations:
-        positions.add( int(mutation[1:-1]) )
-    for child in node.children :
-        positions.update( get_positions( child ) ) 
-    return positions 
-
-### create bootstrap weights by alignment position
-def create_bootstrap( positions, n_samples=None ) :
-    bootstrap_weights = defaultdict(int)  # Initialize a defaultdict to store counts
+### mutation positions, sorted
+def get_positions( flat_tree ) :
+    return np.unique( flat_tree.mutation_position )
+
+def replicate_rng( seed, kind, replicate ) :
+    """
+    Random generator of one bootstrap replicate. Its stream depends only on
+    the master seed, the kind of bootstrap and the replicate number, so a
+    replicate comes out the same whichever run, process or host computes it.
+    """
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(STORE_KINDS.index(kind), replicate)))
+
+### create bootstrap weights by alignment position: how often each position is drawn when resampling them all with replacement
+def create_bootstrap( positions, rng, n_samples=None ) :
     if n_samples is None:
         n_samples = len(positions)  # Default to the size of the original set
-    positions_list = list(positions)  # Convert set to list for indexing
-    for _ in range(n_samples):
-        selected_position = random.choice(positions_list)
-        bootstrap_weights[selected_position] += 1
-    return dict(bootstrap_weights)
-
-def compute_mutation_spectrum(node, stop_nodes, spectrum_dict, weights=None, max_branch_length=100000):
-    if node in spectrum_dict:
-        return spectrum_dict[node]
-    
-    local_spectrum = defaultdict(int)
-    for child in node.children:
-        if any(child.id == stop_node.id for stop_node in stop_nodes):
-            continue
-        child_spectrum = compute_mutation_spectrum(child, stop_nodes, spectrum_dict, weights, max_branch_length)
-        for mutation_type, count in child_spectrum.items():
-            local_spectrum[mutation_type] += count
-
-    if len(node.mutations) <= max_branch_length :
-        for mutation in node.mutations:
-            char1 = mutation[0]
-            char2 = mutation[-1]
-            mutation_type = char1 + char2
-            pos = int(mutation[1:-1])
-            
-            # Assign weight 1 if weights is None; otherwise, check if pos is in weights dict and it gets that weigth or 0 otherwise
-            weight = weights.get(pos, 0) if weights else 1
-            local_spectrum[mutation_type] += weight
-    
-    spectrum_dict[node] = local_spectrum
-    return local_spectrum
+    draws = rng.multinomial(n_samples, np.full(len(positions), 1.0 / len(positions)))
+    drawn = np.nonzero(draws)[0]
+    return dict(zip(positions[drawn].tolist(), draws[drawn].tolist()))
+
+def get_stop_spectra(flat_tree, stop_nodes, subtree_spectra):
+    """
+    Spectrum of the region owned by each stop node: its subtree minus the
+    subtrees of any stop nodes nested below it. Returns the sorted stop node
+    indices and one spectrum row per stop node.
+    """
+    stops = np.array(sorted(stop_nodes), dtype=np.int64)
+    stop_start = flat_tree.subtree_start[stops]
+    stop_spectra = subtree_spectra[stops].copy()
+    # nested stops precede their ancestors in postorder, so each region is final before it is subtracted
+    cumulative = np.zeros((len(stops) + 1, 12), dtype=np.int64)
+    for k in range(len(stops)):
+        first_nested = np.searchsorted(stops, stop_start[k])
+        stop_spectra[k] -= cumulative[k] - cumulative[first_nested]
+        cumulative[k + 1] = cumulative[k] + stop_spectra[k]
+    return stops, stop_spectra
+
+def compute_mutation_spectrum(flat_tree, node, stops, stop_spectra, subtree_spectra):
+    """
+    Spectra of every node below node, excluding the subtrees rooted at stops.
+    Returns the postorder indices of the nodes in that region and a matching
+    array of spectra; node itself is always the last entry.
+    """
+    lo = int(flat_tree.subtree_start[node])
+    first, last = np.searchsorted(stops, [lo, node])
+    nested = stops[first:last]
+
+    # each nested stop's region is removed from all of its ancestors through a cumulative sum at its parent
+    correction = np.zeros((node - lo + 2, 12), dtype=np.int64)
+    np.add.at(correction, flat_tree.parent[nested] - lo + 1, stop_spectra[first:last])
+    np.cumsum(correction, axis=0, out=correction)
+    node_start = flat_tree.subtree_start[lo:node + 1] - lo
+    spectra = subtree_spectra[lo:node + 1] - (correction[1:] - correction[node_start])
+
+    in_region = np.ones(node - lo + 1, dtype=bool)
+    for stop in nested.tolist():
+        in_region[flat_tree.subtree_start[stop] - lo:stop - lo + 1] = False
+    return lo + np.nonzero(in_region)[0], spectra[in_region]
 
 def compute_spectrum_difference(spectrum1, spectrum2):
     difference_spectrum = defaultdict(int)
@@ -83,202 +112,582 @@ def subtract_spectra(spectrum1, spectrum2):
             remainder_spectrum[key] -= value
     return remainder_spectrum
 
-def normalize_spectrum(d):
-    total = sum(d.values())
+def normalize_spectrum(spectrum):
+    total = spectrum.sum()
     if total == 0:
         raise ValueError("Cannot normalize because the total sum of values is 0.")
-    normalized_d = {key: val / total for key, val in d.items()}
-    return normalized_d
+    return spectrum / total
 
-def get_spectra(finalized_splits, max_branch_length, weights=None):
+def get_spectra(flat_tree, finalized_splits, weights=None):
+    counts = flat_tree.counts if weights is None else flat_tree.weighted_counts(weights)
+    stops, stop_spectra = get_stop_spectra(flat_tree, finalized_splits, flat_tree.subtree_spectra(counts))
     final_spectra = {} 
-    for split_root in finalized_splits:
-        print(f"Computing spectrum for subtree beginning at {split_root.id}", file=sys.stderr)
-        spectrum_dict = {}
-        final_spectra[split_root] = compute_mutation_spectrum(split_root, finalized_splits, spectrum_dict, weights, max_branch_length)
+    for k in reversed(range(len(stops))):
+        print(f"Computing spectrum for subtree beginning at {flat_tree.ids[stops[k]]}", file=sys.stderr)
+        final_spectra[int(stops[k])] = stop_spectra[k]
     return final_spectra
 
-def write_spectra_to_tsv(spectra_dict, filename, ntips):
-    all_keys = set()
-    for spectrum in spectra_dict.values():
-        all_keys.update(spectrum.keys())
-    sorted_keys = sorted(all_keys)
-    with open(filename, "w", newline="") as file:
-        writer = csv.writer(file, delimiter='\t')
-        header = ["Node_ID"] + ["Total_Mutations"] + ["Number_Tips"] + ["Mutations:Tips"]+ sorted_keys + ["Exemplar tips"]
-        writer.writerow(header)
-        for node, spectrum in spectra_dict.items():
-            tips = get_tips( spectra_dict.keys(), node )
-            if ntips > 0 :
-                normalized_spectrum = normalize_spectrum(spectrum)
-                row = [node.id] + [sum(spectrum.values())] + [len(tips)] + [float(sum(spectrum.values()))/float(len(tips))] + [normalized_spectrum.get(key, 0) for key in sorted_keys] + [write_tips( tips, ntips )] 
-                writer.writerow(row)
-            else:
+def write_spectra_to_tsv(flat_tree, spectra_dict, filename, ntips, tip_partition=None):
+    with metrics.phase("write_output"):
+        if tip_partition is None:
+            tip_partition = partition_tips(flat_tree, np.array(sorted(spectra_dict.keys()), dtype=np.int64), ntips)
+        tip_counts, exemplars = tip_partition
+        # written under a temporary name and renamed, so an interrupted run never leaves a partial file behind
+        directory, name = os.path.split(os.path.abspath(filename))
+        staging_path = os.path.join(directory, f".{name}.tmp")
+        with open(staging_path, "w", newline="") as file:
+            writer = csv.writer(file, delimiter='\t')
+            header = ["Node_ID"] + ["Total_Mutations"] + ["Number_Tips"] + ["Mutations:Tips"]+ MUTATION_TYPES + ["Exemplar tips"]
+            writer.writerow(header)
+            for node, spectrum in spectra_dict.items():
+                total = int(spectrum.sum())
                 normalized_spectrum = normalize_spectrum(spectrum)
-                row = [node.id] + [sum(spectrum.values())] + [len(tips)] + [float(sum(spectrum.values()))/float(len(tips))] + [normalized_spectrum.get(key, 0) for key in sorted_keys]
+                row = [flat_tree.ids[node]] + [total] + [tip_counts[node]] + [float(total)/float(tip_counts[node])] + normalized_spectrum.tolist()
+                if ntips > 0 :
+                    row += [write_tips( exemplars[node] )]
                 writer.writerow(row)
-    print(f"Spectra written to {filename}", file=sys.stderr)
+        os.replace(staging_path, filename)
+        print(f"Spectra written to {filename}", file=sys.stderr)
 
-def get_tips(splits, node):
-    tips = []
-    def traverse(current_node):
-        if current_node.is_leaf():
-            tips.append(current_node.id)
-        else:
-            for child in current_node.children:
-                if any(child.id == split.id for split in splits):
-                    continue
-                traverse(child)
-    traverse(node)
-    return tips
+def partition_tips(flat_tree, splits, ntips=0):
+    """
+    Assign every tip to its enclosing split in the sorted array splits and
+    return the number of tips of each split plus up to ntips exemplar tip
+    ids, as two dicts keyed by split node. Splits with fewer than ntips tips
+    list all of them in tree order; otherwise the exemplars are a uniform
+    sample, taken as the ntips tips with the smallest random keys, which is
+    the array form of a fixed-size reservoir.
+    """
+    tip_nodes = np.nonzero(flat_tree.is_leaf)[0]
+    tip_owner = flat_tree.region_owner(splits)[tip_nodes]
+    tip_nodes, tip_owner = tip_nodes[tip_owner >= 0], tip_owner[tip_owner >= 0]
+    counts = np.bincount(tip_owner, minlength=len(splits))
+    tip_counts = {int(split): int(count) for split, count in zip(splits.tolist(), counts.tolist())}
 
-def write_tips(tips, ntips):
+    exemplars = {int(split): [] for split in splits.tolist()}
+    if ntips > 0 and len(tip_nodes) > 0:
+        order = np.lexsort((np.random.random_sample(len(tip_nodes)), tip_owner))
+        rank = np.arange(len(order)) - np.searchsorted(tip_owner[order], tip_owner[order])
+        sampled = order[rank < ntips]
+        for k, tip in zip(tip_owner[sampled].tolist(), tip_nodes[sampled].tolist()):
+            exemplars[int(splits[k])].append(tip)
+        # small splits keep their tips in tree order
+        for k, split in enumerate(splits.tolist()):
+            if counts[k] < ntips:
+                exemplars[split].sort()
+            exemplars[split] = [flat_tree.ids[tip] for tip in exemplars[split]]
+    return tip_counts, exemplars
+
+def write_tips(tips):
     if len(tips) == 0:
         return
-    elif len(tips) < ntips:
-        return ','.join(tips)
-    else:
-        return ','.join(random.sample(tips, ntips))
-
-def find_splits(node, min_chi, min_mutations, max_branch_length, weights=None ):
-    accepted_splits = set({node})
-    finalized_splits = set()
+    return ','.join(tips)
+
+def chi2_statistics(node_spectra, above_spectra, block_size=65536):
+    """
+    Chi-square statistic of the 2 x 12 contingency table [node, above] for
+    every row of node_spectra/above_spectra at once. The arithmetic follows
+    scipy.stats.chi2_contingency term for term so the statistics are
+    identical to calling it once per node, including the ValueError it
+    raises when a table has a zero expected frequency.
+    """
+    chi = np.empty(len(node_spectra), dtype=np.float64)
+    for lo in range(0, len(node_spectra), block_size):
+        observed = np.stack([node_spectra[lo:lo + block_size], above_spectra[lo:lo + block_size]], axis=1).astype(np.float64)
+        expected = observed.sum(axis=2, keepdims=True) * observed.sum(axis=1, keepdims=True) / observed.sum(axis=(1, 2), keepdims=True)
+        if np.any(expected == 0):
+            zeropos = tuple(np.argwhere(expected == 0)[0][1:].tolist())
+            raise ValueError(f"The internally computed table of expected frequencies has a zero element at {zeropos}.")
+        terms = (observed - expected) ** 2 / expected
+        chi[lo:lo + block_size] = terms.reshape(len(terms), -1).sum(axis=1)
+    return chi
+
+def chi2_size_bounds(node_totals, split_root_spectrum):
+    """
+    Upper bounds on chi2_statistics(node_spectra, split_root_spectrum -
+    node_spectra) from the node totals alone. For a 2 x 12 table with node
+    row a, row totals n and N - n and column totals R the statistic is
+        chi2 = N^2 / (n (N - n)) * (sum_j a_j^2 / R_j - n^2 / N)
+    and as a_j <= min(n, R_j) the sum is at most n * min(1, n / min(R)), so
+        chi2 <= N n (N - min(R)) / (min(R) (N - n))
+    for n < min(R), and N otherwise. Only small nodes are bounded below N,
+    but most nodes are small. Tables with a zero margin are left unbounded,
+    so they are always tested and raise as before.
+    """
+    total = float(split_root_spectrum.sum())
+    smallest = float(split_root_spectrum.min())
+    node_totals = node_totals.astype(np.float64)
+    if smallest <= 0:
+        return np.full(len(node_totals), np.inf)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bounds = np.where(node_totals < smallest, total * node_totals * (total - smallest) / (smallest * (total - node_totals)), total)
+    bounds[(node_totals <= 0) | (node_totals >= total)] = np.inf
+    # padded to cover rounding in chi2_statistics
+    return bounds * (1 + 1e-9)
+
+def find_max_chi_node(nodes, spectra, min_mutations, block_size=64):
+    """
+    Score every node of a split region against the remainder of the region
+    and return (max_chi, node) for the best one, or (0, None) when no node
+    passes the min_mutations filters. Ties go to the first node in postorder.
+
+    The statistic is first computed for the block_size largest candidates,
+    and then only for those whose chi2_size_bounds reaches the best of them;
+    the others can neither beat nor tie it, so the result is the same as
+    testing every candidate.
+    """
+    split_root_spectrum = spectra[-1]
+    node_totals = spectra.sum(axis=1)
+    split_root_total = split_root_spectrum.sum()
+    candidates = np.nonzero((node_totals >= min_mutations) & (split_root_total - node_totals >= min_mutations))[0]
+    metrics.count("nodes_scored", len(nodes))
+    metrics.count("candidates_filtered", len(nodes) - len(candidates))
+    if len(candidates) == 0:
+        return 0, None
+
+    top = np.argpartition(-node_totals[candidates], block_size - 1)[:block_size] if len(candidates) > block_size else np.arange(len(candidates))
+    top_chi = chi2_statistics(spectra[candidates[top]], split_root_spectrum - spectra[candidates[top]])
+    rest = np.ones(len(candidates), dtype=bool)
+    rest[top] = False
+    rest &= ~(chi2_size_bounds(node_totals[candidates], split_root_spectrum) < top_chi.max())
+    rest = np.nonzero(rest)[0]
+    rest_chi = chi2_statistics(spectra[candidates[rest]], split_root_spectrum - spectra[candidates[rest]])
+    metrics.count("chi2_tests", len(top) + len(rest))
+    metrics.count("candidates_below_size_bound", len(candidates) - len(top) - len(rest))
+
+    tested = np.concatenate([top, rest])
+    chi = np.concatenate([top_chi, rest_chi])
+    max_chi = chi.max()
+    if not max_chi > 0:
+        return 0, None
+    best = int(tested[chi == max_chi].min())
+    return float(max_chi), int(nodes[candidates[best]])
+
+def split_region(flat_tree, region, node):
+    """
+    Carve the subtree of node out of a split region (nodes, spectra). Returns
+    the new region rooted at node and the remainder of the old one, where
+    node's spectrum has been subtracted along the path up to the old root.
+    """
+    nodes, spectra = region
+    first = np.searchsorted(nodes, flat_tree.subtree_start[node])
+    last = np.searchsorted(nodes, node) + 1
+    new_region = (nodes[first:last].copy(), spectra[first:last].copy())
+    remaining_nodes = np.concatenate([nodes[:first], nodes[last:]])
+    remaining_spectra = np.concatenate([spectra[:first], spectra[last:]])
+
+    path = [int(flat_tree.parent[node])]
+    while path[-1] != nodes[-1]:
+        path.append(int(flat_tree.parent[path[-1]]))
+    remaining_spectra[np.searchsorted(remaining_nodes, path)] -= spectra[last - 1]
+    return new_region, (remaining_nodes, remaining_spectra)
+
+### regions shared with the scoring workers, set before each iteration's pool forks so they inherit them copy-on-write
+shared_regions = None
+
+### below this many region nodes in an iteration, forking a pool costs more than it saves
+PARALLEL_MIN_NODES = 100000
+
+def score_worker( task ) :
+    splitRoot, min_mutations = task
+    counters = metrics.snapshot()
+    score = find_max_chi_node(*shared_regions[splitRoot], min_mutations)
+    return splitRoot, score, metrics.counts_since(counters)
+
+def score_regions(regions, split_roots, min_mutations, nthreads=1):
+    """
+    (max_chi, node) of every split root in split_roots. With nthreads > 1
+    the regions are scored on a pool of forked workers, largest first so
+    the long ones do not end up last; each region is scored exactly as in
+    the serial loop, so the scores are identical.
+    """
+    if nthreads <= 1 or len(split_roots) <= 1 or sum(len(regions[splitRoot][0]) for splitRoot in split_roots) < PARALLEL_MIN_NODES:
+        return {splitRoot: find_max_chi_node(*regions[splitRoot], min_mutations) for splitRoot in split_roots}
+    global shared_regions
+    shared_regions = regions
+    tasks = [(splitRoot, min_mutations) for splitRoot in sorted(split_roots, key=lambda splitRoot: (-len(regions[splitRoot][0]), splitRoot))]
+    scores = {}
+    gc.freeze()
+    try:
+        with multiprocessing.get_context("fork").Pool(min(nthreads, len(tasks))) as pool:
+            for splitRoot, score, counts in pool.imap_unordered(score_worker, tasks):
+                scores[splitRoot] = score
+                metrics.add_counts(counts)
+    finally:
+        gc.unfreeze()
+        shared_regions = None
+    return scores
+
+def find_splits(flat_tree, min_chi, min_mutations, weights=None, resume=None, checkpoint=None, nthreads=1 ):
+    """
+    Split the tree until no region has a node above min_chi and return the
+    finalized split roots. resume is an (accepted, finalized) pair of node
+    index sets to continue from, and checkpoint, if given, is called with
+    the two sets after every iteration. The regions that need scoring in an
+    iteration are scored on nthreads processes.
+    """
+    # the spectrum bookkeeping and the chi-square scoring are timed as separate phases
+    with metrics.phase("region_spectra"):
+        counts = flat_tree.counts if weights is None else flat_tree.weighted_counts(weights)
+        subtree_spectra = flat_tree.subtree_spectra(counts)
+        # per split root state kept across iterations: the nodes and spectra of its region, and its best candidate
+        if resume is None:
+            no_stops = (np.empty(0, dtype=np.int64), np.empty((0, 12), dtype=np.int64))
+            regions = {flat_tree.root: compute_mutation_spectrum(flat_tree, flat_tree.root, *no_stops, subtree_spectra)}
+            accepted_splits = set({flat_tree.root})
+            finalized_splits = set()
+        else:
+            # a region is its split root's subtree less the subtrees of the accepted splits below it
+            accepted_splits, finalized_splits = set(resume[0]), set(resume[1])
+            stops, stop_spectra = get_stop_spectra(flat_tree, accepted_splits, subtree_spectra)
+            regions = {splitRoot: compute_mutation_spectrum(flat_tree, splitRoot, stops, stop_spectra, subtree_spectra) for splitRoot in accepted_splits - finalized_splits}
+    scores = {}
     while len(accepted_splits) > len(finalized_splits):
         print(f"Starting iteration with {len(accepted_splits)-1} accepted splits and {len(finalized_splits)} finalized splits", file=sys.stderr)
-        new_split = set()
-        for splitRoot in accepted_splits:
-            if any(splitRoot.id == stop_node.id for stop_node in finalized_splits):
-                print(f"Finalized split skipped:  {splitRoot.id}", file=sys.stderr)
+        metrics.count("find_splits_iterations")
+        new_split = {}
+        # the regions are independent, so all of the iteration's new ones are scored up front
+        unscored = [splitRoot for splitRoot in sorted(accepted_splits, reverse=True) if splitRoot not in finalized_splits and splitRoot not in scores]
+        for splitRoot in unscored:
+            print(f"Computing distances between splits in (sub)tree {flat_tree.ids[splitRoot]}", file=sys.stderr)
+        with metrics.phase("chi2_scoring"):
+            scores.update(score_regions(regions, unscored, min_mutations, nthreads))
+        metrics.count("regions_scored", len(unscored))
+        for splitRoot in sorted(accepted_splits, reverse=True):
+            if splitRoot in finalized_splits:
+                print(f"Finalized split skipped:  {flat_tree.ids[splitRoot]}", file=sys.stderr)
                 continue
-            print(f"Computing spectrum for subtree beginning at {splitRoot.id}", file=sys.stderr)
-            spectrum_dict = {}
-            split_root_spectrum = compute_mutation_spectrum(splitRoot, accepted_splits, spectrum_dict, weights, max_branch_length)
-            print(f"Computing distances between splits in (sub)tree {splitRoot.id}", file=sys.stderr)
-            max_chi = 0
-            max_chi_node = None
-            for node in spectrum_dict:
-                if sum(spectrum_dict[node].values()) < min_mutations:
-                    continue
-                if sum(split_root_spectrum.values()) - sum(spectrum_dict[node].values()) < min_mutations:
-                    continue
-                
-                splitroot_spectrum_list = []
-                above_spectrum_list = [] 
-                for mutation in ["AC","AG","AT","CA","CG","CT","GA","GC","GT","TA","TC","TG"] :
-                    if mutation in spectrum_dict[node].keys():
-                        splitroot_spectrum_list.append(spectrum_dict[node][mutation])
-                    else:
-                        # Append 0 if the mutation is missing from the spectrum
-                        splitroot_spectrum_list.append(0)
-                    
-                    if mutation in split_root_spectrum.keys():
-                        # Calculate the difference, but handle cases where mutation is missing from node
-                        above_spectrum_list.append(split_root_spectrum[mutation] - spectrum_dict[node].get(mutation, 0))
-                    else:
-                        # Append 0 if the mutation is missing from the split_root_spectrum
-                        above_spectrum_list.append(0)
-
-                chi, p, dof, expected = chi2_contingency([splitroot_spectrum_list,above_spectrum_list])
-
-                '''
-                node_spectrum_difference = compute_spectrum_difference(
-                    normalize_spectrum(spectrum_dict[node]),
-                    normalize_spectrum(subtract_spectra(split_root_spectrum, spectrum_dict[node]))
-                )
-                chi = sum(node_spectrum_difference.values()) * min(
-                    sum(spectrum_dict[splitRoot].values()) - sum(spectrum_dict[node].values()),
-                    sum(spectrum_dict[node].values())
-                )
-                '''
-                
-                if chi > max_chi:
-                    max_chi = chi
-                    max_chi_node = node
+            max_chi, max_chi_node = scores[splitRoot]
             if max_chi > min_chi:
-                if max_chi_node and max_chi_node not in accepted_splits:
-                    new_split.add(max_chi_node)
-                    print(f"New split found at {max_chi_node.id} with x2 {max_chi}", file=sys.stderr)
+                if max_chi_node is not None and max_chi_node not in accepted_splits:
+                    new_split[max_chi_node] = splitRoot
+                    print(f"New split found at {flat_tree.ids[max_chi_node]} with x2 {max_chi}", file=sys.stderr)
             else:
                 finalized_splits.add(splitRoot)
-                print(f"Finalized subtree rooted at {splitRoot.id}", file=sys.stderr)
+                del regions[splitRoot]
+                print(f"Finalized subtree rooted at {flat_tree.ids[splitRoot]}", file=sys.stderr)
+
+        # only the regions that gained a split change, so only those are rescored next iteration
+        with metrics.phase("region_spectra"):
+            for node, splitRoot in new_split.items():
+                print(f"Updating spectra between {flat_tree.ids[node]} and {flat_tree.ids[splitRoot]}", file=sys.stderr)
+                regions[node], regions[splitRoot] = split_region(flat_tree, regions[splitRoot], node)
+                del scores[splitRoot]
         accepted_splits = accepted_splits.union(new_split)
         print(f"End of iteration: {len(new_split)} new splits added, {len(accepted_splits) -1} total accepted splits", file=sys.stderr)
+        if checkpoint is not None:
+            checkpoint(accepted_splits, finalized_splits)
     return finalized_splits
 
-def bootstrap_replicate ( tree, replicate, min_chi, min_mutations, ntips, max_branch_length ) :
-    print(f"Begining bootstrap no: {replicate}", file=sys.stderr)
-    positions = get_positions( tree.root )
-    bootstrap_weights = create_bootstrap( positions )
-    finalized_splits_bootstrap = find_splits(tree.root, min_chi, min_mutations, max_branch_length, bootstrap_weights)
-    bootstrap_spectra = get_spectra(finalized_splits_bootstrap, max_branch_length, bootstrap_weights)
-    bootstrap_output_file = f"bootstrap_{replicate}_splits_output.tsv"
-    write_spectra_to_tsv(bootstrap_spectra, bootstrap_output_file, ntips)
-
-# Define the run_bootstrap function using explicit process creation
-def run_bootstrap(tree, nbootstraps, nthreads, min_chi, min_mutations, max_branch_length):
-    processes = []
-    # Create and start a process for each bootstrap replicate
-    for replicate in range(1, nbootstraps + 1):
-        p = Process(target=bootstrap_replicate, args=(tree, replicate, min_chi, min_mutations, 0, max_branch_length))
-        processes.append(p)
-        p.start()
-        # If we have reached the maximum number of threads, wait for them to finish
-        if len(processes) >= nthreads:
-            for p in processes:
-                p.join()
-            processes = []
-    # Wait for any remaining processes to finish
-    for p in processes:
-        p.join()
-
-    print(f"Bootstrap completed with {nbootstraps} replicates using {nthreads} threads.")
-
-def bootstrap_spectrum_replicate( tree, replicate, splits, max_branch_lengths):
+def bootstrap_replicate ( flat_tree, replicate, min_chi, min_mutations, seed ) :
     print(f"Begining bootstrap no: {replicate}", file=sys.stderr)
-    positions = get_positions( tree.root )
-    bootstrap_weights = create_bootstrap( positions )
-    bootstrap_spectra = get_spectra( splits, max_branch_lengths, bootstrap_weights)
-    bootstrap_output_file = f"bootstrap_{replicate}_spectra_output.tsv"
-    write_spectra_to_tsv(bootstrap_spectra, bootstrap_output_file, 0)
+    positions = get_positions( flat_tree )
+    bootstrap_weights = create_bootstrap( positions, replicate_rng(seed, "splits", replicate) )
+    finalized_splits_bootstrap = find_splits(flat_tree, min_chi, min_mutations, bootstrap_weights)
+    return get_spectra(flat_tree, finalized_splits_bootstrap, bootstrap_weights)
+
+### tree shared with the bootstrap workers, set before the pool forks so they inherit it copy-on-write
+shared_tree = None
+
+def bootstrap_worker( task ) :
+    replicate, min_chi, min_mutations, seed = task
+    # timings and counters are returned with the result, since the worker's metrics stay in the worker
+    start = time.perf_counter()
+    counters = metrics.snapshot()
+    # a failing replicate is reported back rather than raised, which would end the whole run in the parent
+    try:
+        bootstrap_spectra, error = bootstrap_replicate( shared_tree, replicate, min_chi, min_mutations, seed ), None
+    except Exception as e:
+        bootstrap_spectra, error = None, f"{type(e).__name__}: {e}"
+    return replicate, bootstrap_spectra, error, time.perf_counter() - start, metrics.counts_since(counters)
+
+# Define the run_bootstrap function using a pool of long-lived workers
+def run_bootstrap(flat_tree, replicates, nthreads, min_chi, min_mutations, store=None, seed=0):
+    """
+    Run the split bootstrap replicates on nthreads processes and write each
+    one as it finishes. A replicate that fails is logged and skipped; the
+    failures are returned as a replicate -> error message dict.
+    """
+    global shared_tree
+    shared_tree = flat_tree
+    tasks = [(replicate, min_chi, min_mutations, seed) for replicate in replicates]
+    failed = {}
+    # keep the collector away from the inherited objects so their pages stay shared with the parent
+    gc.freeze()
+    try:
+        with multiprocessing.get_context("fork").Pool(nthreads) as pool:
+            # replicates are handed out one at a time and written as soon as each one finishes
+            for replicate, bootstrap_spectra, error, seconds, counts in pool.imap_unordered(bootstrap_worker, tasks):
+                metrics.replicate("splits", replicate, seconds)
+                metrics.add_counts(counts)
+                if error is not None:
+                    print(f"Bootstrap replicate {replicate} failed and is skipped: {error}", file=sys.stderr)
+                    metrics.count("bootstrap_replicates_failed")
+                    failed[replicate] = error
+                    continue
+                if store is not None:
+                    store.add(flat_tree, replicate, bootstrap_spectra)
+                    continue
+                bootstrap_output_file = f"bootstrap_{replicate}_splits_output.tsv"
+                write_spectra_to_tsv(flat_tree, bootstrap_spectra, bootstrap_output_file, 0)
+    finally:
+        gc.unfreeze()
+
+    print(f"Bootstrap completed with {len(tasks) - len(failed)} replicates using {nthreads} threads, {len(failed)} failed.")
+    return failed
+
+def spectrum_incidence(flat_tree, splits):
+    """
+    Sparse (splits x 12) by positions matrix holding, for every split region
+    and mutation type, the number of mutations at each alignment position.
+    Returns the sorted splits, the positions and the matrix.
+    """
+    stops = np.array(sorted(splits), dtype=np.int64)
+    positions = np.unique(flat_tree.mutation_position)
+    owner = flat_tree.region_owner(stops)[flat_tree.mutation_node]
+    mask = flat_tree.spectrum_mask() & (owner >= 0)
+    rows = owner[mask].astype(np.int64) * 12 + flat_tree.mutation_type[mask]
+    columns = np.searchsorted(positions, flat_tree.mutation_position[mask])
+    incidence = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, columns)), shape=(len(stops) * 12, len(positions)))
+    return stops, positions, incidence
+
+### positions x replicates resampling counts, one multinomial draw from each replicate's own stream
+def draw_bootstrap_weights( npositions, replicates, seed ) :
+    uniform = np.full(npositions, 1.0 / npositions)
+    return np.stack([replicate_rng(seed, "spectra", replicate).multinomial(npositions, uniform) for replicate in replicates], axis=1)
 
 ### ok, botostrap by spectrum
-def run_bootstrap_spectra( tree, nbootstraps, nthreads, splits, max_branch_lengths ) :
-    processes = []
-    # Create and start a process for each bootstrap replicate
-    for replicate in range(1, nbootstraps + 1):
-        p = Process(target=bootstrap_spectrum_replicate, args=(tree, replicate, splits, max_branch_lengths))
-        processes.append(p)
-        p.start()
-        # If we have reached the maximum number of threads, wait for them to finish
-        if len(processes) >= nthreads:
-            for p in processes:
-                p.join()
-            processes = []
-    # Wait for any remaining processes to finish
-    for p in processes:
-        p.join()
-    print(f"Bootstrap spectrum completed with {nbootstraps} replicates using {nthreads} threads.")
+def run_bootstrap_spectra( flat_tree, replicates, splits, block_size=100, store=None, seed=0 ) :
+    # the partition is fixed, so each block of replicates is a single sparse product with its weight matrix
+    stops, positions, incidence = spectrum_incidence(flat_tree, splits)
+    tip_partition = partition_tips(flat_tree, stops)
+    replicates = list(replicates)
+    for first in range(0, len(replicates), block_size):
+        block = replicates[first:first + block_size]
+        print(f"Computing bootstrap spectra for replicates {block[0]} to {block[-1]}", file=sys.stderr)
+        start = time.perf_counter()
+        spectra = (incidence @ draw_bootstrap_weights(len(positions), block, seed)).reshape(len(stops), 12, len(block))
+        # the block's product is shared evenly between its replicates
+        block_seconds = (time.perf_counter() - start) / len(block)
+        for j, replicate in enumerate(block):
+            start = time.perf_counter()
+            bootstrap_spectra = {int(stops[k]): spectra[k, :, j] for k in reversed(range(len(stops)))}
+            if store is not None:
+                store.add(flat_tree, replicate, bootstrap_spectra)
+            else:
+                bootstrap_output_file = f"bootstrap_{replicate}_spectra_output.tsv"
+                write_spectra_to_tsv(flat_tree, bootstrap_spectra, bootstrap_output_file, 0, tip_partition)
+            metrics.replicate("spectra", replicate, block_seconds + time.perf_counter() - start)
+    print(f"Bootstrap spectrum completed with {len(replicates)} replicates.")
+
+def checkpoint_settings(flat_tree, args):
+    """What a checkpoint must agree on to be resumed: the tree and the split finding thresholds."""
+    return {
+        "input_tree": os.path.basename(args.input_tree),
+        "nodes": len(flat_tree),
+        "mutations": len(flat_tree.mutation_node),
+        "max_branch_length": args.max_branch_length,
+        "min_chi": args.min_chi,
+        "min_mutations": args.min_mutations,
+    }
+
+def resume_splits(flat_tree, checkpoint_path, settings):
+    """
+    The accepted and finalized split indices of a checkpoint and the bootstrap
+    seed it recorded (None if it has none), or None when there is no
+    checkpoint to resume from.
+    """
+    checkpoint = read_checkpoint(checkpoint_path, settings)
+    if checkpoint is None:
+        print(f"No checkpoint at {checkpoint_path}, starting from the root", file=sys.stderr)
+        return None
+    try:
+        accepted = {flat_tree.index[node_id] for node_id in checkpoint["accepted"]}
+        finalized = {flat_tree.index[node_id] for node_id in checkpoint["finalized"]}
+    except KeyError as e:
+        raise ValueError(f"checkpoint {checkpoint_path} names node {e} which is not in the tree")
+    print(f"Resuming from {checkpoint_path} with {len(accepted) - 1} accepted splits and {len(finalized)} finalized splits", file=sys.stderr)
+    return accepted, finalized, checkpoint.get("seed")
+
+def bootstrap_seed(args, checkpoint_seed, written):
+    """
+    The master seed of the run's bootstrap replicates: --seed, else the one a
+    resumed checkpoint recorded, else a fresh one, which is printed. Refuses
+    to add replicates to those already written from another seed, or from an
+    unrecorded one when no --seed is given, since the two sets could not be
+    reproduced together.
+    """
+    seed = args.seed if args.seed is not None else checkpoint_seed
+    if written and seed is None:
+        raise ValueError(f"{len(written)} bootstrap replicates were written with a seed the checkpoint does not record; resume with the --seed that run printed or remove them")
+    if written and checkpoint_seed is not None and seed != checkpoint_seed:
+        raise ValueError(f"{len(written)} bootstrap replicates were written with seed {checkpoint_seed}; resume without --seed or remove them")
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+        print(f"Bootstrap seed: {seed} (pass --seed {seed} to repeat these replicates)", file=sys.stderr)
+    elif args.seed is None:
+        print(f"Bootstrap seed: {seed}, from the checkpoint", file=sys.stderr)
+    return seed
+
+def state_settings(args):
+    """What a saved state must agree on to warm start a run: the split finding thresholds."""
+    return {
+        "max_branch_length": args.max_branch_length,
+        "min_chi": args.min_chi,
+        "min_mutations": args.min_mutations,
+    }
+
+def warm_start_splits(flat_tree, state, min_chi, min_mutations, tolerance):
+    """
+    Accepted and finalized splits to resume find_splits from, given the state
+    of a run on an earlier release of the tree. The old splits are mapped to
+    the new tree by their tips (one per new node, the deepest one winning),
+    and a region stays finalized when the mapping is exact and its mutation
+    type counts changed by at most tolerance of their old total. Every other
+    split is tested against the region around it as find_splits would and
+    dropped if it no longer passes min_chi and min_mutations; the regions it
+    leaves are reopened. Also returns the new node -> old split index of the
+    carried splits, the exactness of each old split's mapping, the change
+    of every carried region and the new node of every old tip, for
+    write_warm_report.
+    """
+    nodes, exact, tip_index = map_splits(flat_tree, state)
+    subtree_spectra = flat_tree.subtree_spectra(flat_tree.counts)
+    root_split = len(nodes) - 1
+    carried = {flat_tree.root: root_split}
+    for k, node in enumerate(nodes.tolist()):
+        if node >= 0 and node not in carried:
+            carried[node] = k
+    accepted = set(carried)
+    dropped = set()
+    while True:
+        stops, stop_spectra = get_stop_spectra(flat_tree, accepted, subtree_spectra)
+        old_counts = state["region_counts"][[carried[stop] for stop in stops.tolist()]]
+        change = np.abs(stop_spectra - old_counts).sum(axis=1) / np.maximum(old_counts.sum(axis=1), 1)
+        owner = flat_tree.region_owner(stops)
+        reopen = (change > tolerance) | ~exact[[carried[stop] for stop in stops.tolist()]]
+        reopen[owner[sorted(dropped)]] = True
+
+        # a reopened split has to hold up against the region around it; the root is last and always stays
+        tested = np.nonzero(reopen[:-1])[0]
+        around = owner[flat_tree.parent[stops[tested]]]
+        totals = stop_spectra.sum(axis=1)
+        passes = (totals[tested] >= min_mutations) & (totals[around] >= min_mutations)
+        chi = np.zeros(len(tested))
+        chi[passes] = chi2_statistics(stop_spectra[tested[passes]], stop_spectra[around[passes]])
+        failed = stops[tested[~(passes & (chi > min_chi))]].tolist()
+        if not failed:
+            break
+        for node in failed:
+            print(f"Dropping split {flat_tree.ids[node]}, which no longer passes against the region around it", file=sys.stderr)
+        accepted.difference_update(failed)
+        dropped.update(failed)
+    metrics.count("warm_splits_dropped", len(dropped))
+    metrics.count("warm_regions_reopened", int(reopen.sum()))
+
+    finalized = set(stops[~reopen].tolist())
+    print(f"Warm start with {len(accepted) - 1} carried splits, {len(dropped)} dropped, {int(reopen.sum())} of {len(stops)} regions to re-evaluate", file=sys.stderr)
+    return accepted, finalized, carried, exact, dict(zip(stops.tolist(), change.tolist())), tip_index
+
+def completed_replicates(kind, store_path=None):
+    """Bootstrap replicates of a kind already written, to the store or as TSV files in the working directory."""
+    if store_path is not None:
+        return stored_replicates(store_path, kind)
+    prefix, suffix = "bootstrap_", f"_{kind}_output.tsv"
+    return {int(name[len(prefix):-len(suffix)]) for name in os.listdir(".") if name.startswith(prefix) and name.endswith(suffix) and name[len(prefix):-len(suffix)].isdigit()}
 
 def main():
 
     ### read args and tree
     args = parse_args()
-    tree = bte.MATree(args.input_tree)
+    configure_metrics(args)
+
+    ### flatten the tree once (or map it from the cache), everything downstream works on the arrays
+    with metrics.phase("load_tree"):
+        flat_tree = load_flat_tree(args.input_tree, args.tree_cache, args.max_branch_length)
+
+    ### when asked for, the split search is checkpointed after every iteration so an interrupted run can be resumed
+    checkpointing = args.checkpoint is not None or args.resume
+    checkpoint_path = args.checkpoint or f"{args.output_spectrum}.checkpoint.json"
+    settings = checkpoint_settings(flat_tree, args)
+    resume = resume_splits(flat_tree, checkpoint_path, settings) if args.resume else None
+    checkpoint_seed = None
+    if resume is not None:
+        accepted, finalized, checkpoint_seed = resume
+        resume = accepted, finalized
+
+    ### every replicate's draws derive from one master seed, kept in the checkpoint so a resumed run continues with it
+    seed = None
+    if args.bootstrap_splits > 0 or args.bootstrap_spectra > 0:
+        written = set()
+        if args.resume:
+            written = {(kind, replicate) for kind in STORE_KINDS for replicate in completed_replicates(kind, args.bootstrap_store)}
+        seed = bootstrap_seed(args, checkpoint_seed, written)
+    def checkpoint(accepted, finalized):
+        write_checkpoint(checkpoint_path, settings, [flat_tree.ids[node] for node in accepted], [flat_tree.ids[node] for node in finalized], seed)
+    if not checkpointing:
+        checkpoint = None
+
+    ### a warm start carries over the previous release's splits and only searches the regions that changed
+    warm = None
+    if resume is None and args.warm_start is not None:
+        with metrics.phase("warm_start"):
+            state = read_state(args.warm_start, state_settings(args))
+            accepted, finalized, *mapping = warm_start_splits(flat_tree, state, args.min_chi, args.min_mutations, args.warm_tolerance)
+        resume = accepted, finalized
+        warm = state, *mapping
+
+    # recorded before the search, which a complete checkpoint or warm start skips, so the seed is always saved
+    if checkpoint is not None and resume is not None:
+        checkpoint(*resume)
+    elif checkpoint is not None:
+        checkpoint({flat_tree.root}, set())
 
     ### go through and do the real run without weighting mutations 
-    finalized_splits = find_splits(tree.root, args.min_chi, args.min_mutations, args.max_branch_length )
-    spectra = get_spectra(finalized_splits, args.max_branch_length )
-    write_spectra_to_tsv(spectra, args.output_spectrum, args.ntips)
+    with metrics.phase("find_splits"):
+        if resume is not None and len(resume[0]) == len(resume[1]):
+            finalized_splits = resume[1]
+        else:
+            finalized_splits = find_splits(flat_tree, args.min_chi, args.min_mutations, resume=resume, checkpoint=checkpoint, nthreads=args.nthreads )
+    with metrics.phase("spectra"):
+        spectra = get_spectra(flat_tree, finalized_splits )
+    write_spectra_to_tsv(flat_tree, spectra, args.output_spectrum, args.ntips)
+    if args.save_state is not None:
+        write_state(args.save_state, flat_tree, spectra, state_settings(args))
+    if warm is not None:
+        report_path = f"{args.output_spectrum}.warm_start.tsv"
+        statuses = write_warm_report(report_path, flat_tree, *warm, finalized_splits)
+        print(f"Warm start report written to {report_path}: {', '.join(f'{n} {status}' for status, n in statuses.items())} splits", file=sys.stderr)
 
     ### get bootstrap splits if requested
     if ( args.bootstrap_splits > 0 ) :
         print(f"Bootstrapping splits with {args.bootstrap_splits} replicates using {args.nthreads} threads.", file=sys.stderr)
-        run_bootstrap( tree, args.bootstrap_splits, args.nthreads, args.min_chi, args.min_mutations, args.max_branch_length )
+        done = completed_replicates("splits", args.bootstrap_store) if args.resume else set()
+        if done:
+            print(f"Skipping {len(done)} split bootstrap replicates that are already written", file=sys.stderr)
+        replicates = [replicate for replicate in range(1, args.bootstrap_splits + 1) if replicate not in done]
+        with metrics.phase("bootstrap_splits"):
+            if args.bootstrap_store is None:
+                run_bootstrap( flat_tree, replicates, args.nthreads, args.min_chi, args.min_mutations, seed=seed )
+            else:
+                with BootstrapStoreWriter(args.bootstrap_store, "splits") as store:
+                    run_bootstrap( flat_tree, replicates, args.nthreads, args.min_chi, args.min_mutations, store, seed )
 
     ### bootstrap spectrum requested:
     if ( args.bootstrap_spectra > 0 ) :
-        print(f"Bootstrapping spectra with {args.bootstrap_spectra} replicates using {args.nthreads} threads.", file=sys.stderr)
-        run_bootstrap_spectra( tree, args.bootstrap_spectra, args.nthreads, finalized_splits, args.max_branch_length )
+        print(f"Bootstrapping spectra with {args.bootstrap_spectra} replicates.", file=sys.stderr)
+        done = completed_replicates("spectra", args.bootstrap_store) if args.resume else set()
+        if done:
+            print(f"Skipping {len(done)} spectrum bootstrap replicates that are already written", file=sys.stderr)
+        replicates = [replicate for replicate in range(1, args.bootstrap_spectra + 1) if replicate not in done]
+        with metrics.phase("bootstrap_spectra"):
+            if args.bootstrap_store is None:
+                run_bootstrap_spectra( flat_tree, replicates, finalized_splits, seed=seed )
+            else:
+                with BootstrapStoreWriter(args.bootstrap_store, "spectra") as store:
+                    run_bootstrap_spectra( flat_tree, replicates, finalized_splits, store=store, seed=seed )
+
+    finish_metrics(args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,46 @@
+import numpy as np
+
+# Explicit-stack tree traversals. They work on any node object with a
+# children list (bte nodes, CachedNode), never recurse, and so handle the
+# deep, ladder-like trees that overflow Python's recursion limit.
+
+def preorder(root):
+    """Nodes in preorder, children left to right."""
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
+
+def postorder(root):
+    """Nodes in postorder, children left to right."""
+    stack = [(root, iter(root.children))]
+    while stack:
+        node, remaining = stack[-1]
+        child = next(remaining, None)
+        if child is not None:
+            stack.append((child, iter(child.children)))
+            continue
+        stack.pop()
+        yield node
+
+def preorder_with_state(root, state, update):
+    """
+    Nodes in preorder, each with the state inherited from its parent: the
+    root gets state, and the children of a node get update(node, state).
+    """
+    stack = [(root, state)]
+    while stack:
+        node, state = stack.pop()
+        yield node, state
+        child_state = update(node, state)
+        for child in reversed(node.children):
+            stack.append((child, child_state))
+
+def preorder_indices(flat_tree):
+    """
+    Node indices of a FlatTree in preorder. A node shares its subtree start
+    with the first child below it, so preorder is ascending subtree start
+    with ancestors (larger indices) first.
+    """
+    return np.lexsort((-np.arange(len(flat_tree)), np.asarray(flat_tree.subtree_start)))
@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import errno
+import shutil
+import hashlib
+import argparse
+import numpy as np
+from flat_tree import FlatTree
+from metrics import metrics, add_metrics_args, configure_metrics, finish_metrics
+
+### bump whenever the set or meaning of the cached arrays changes
+CACHE_VERSION = 2
+CACHE_ARRAYS = ["parent", "child_offsets", "children", "subtree_start", "mutation_node", "mutation_code", "branch_length"]
+
+# Command-line argument parsing
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build or verify the on-disk cache of a mutation annotated tree.")
+    parser.add_argument("command", choices=["build", "verify"], help="Build the cache (if missing or stale) or verify an existing one")
+    parser.add_argument("--input_tree", type=str, default="public-latest.all.masked.pb.gz", help="Input tree file (protobuf format)")
+    parser.add_argument("--tree_cache", type=str, default="", help="Cache directory (defaults to a directory next to the input tree named after its content hash)")
+    add_metrics_args(parser)
+    return parser.parse_args()
+
+def content_hash(path, chunk_size=1 << 24):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def default_cache_path(input_tree, digest):
+    directory, name = os.path.split(os.path.abspath(input_tree))
+    return os.path.join(directory, f"{name}.{digest[:16]}.cache")
+
+def read_matree(input_tree):
+    import bte
+    return bte.MATree(input_tree)
+
+def write_cache(flat_tree, cache_path, digest, input_tree):
+    # write into a private directory and rename it into place, so concurrent runs never see a partial cache
+    staging_path = f"{cache_path}.tmp{os.getpid()}"
+    os.makedirs(staging_path)
+    for name in CACHE_ARRAYS:
+        np.save(os.path.join(staging_path, f"{name}.npy"), np.asarray(getattr(flat_tree, name)))
+    with open(os.path.join(staging_path, "ids.txt"), "w") as f:
+        f.write("\n".join(flat_tree.ids))
+    with open(os.path.join(staging_path, "meta.json"), "w") as f:
+        json.dump({"version": CACHE_VERSION, "sha256": digest, "input_tree": os.path.abspath(input_tree), "nodes": len(flat_tree), "mutations": len(flat_tree.mutation_node)}, f, indent=2)
+    # a directory can only be renamed onto a missing or empty one, so a stale cache is first renamed aside; a valid
+    # one, possibly written meanwhile by a concurrent run and mapped by its readers, is kept and the copy discarded
+    while verify_cache(cache_path, digest):
+        if os.path.isdir(cache_path):
+            stale_path = f"{cache_path}.stale{os.getpid()}"
+            try:
+                os.replace(cache_path, stale_path)
+            except FileNotFoundError:
+                pass
+            else:
+                shutil.rmtree(stale_path)
+        try:
+            os.replace(staging_path, cache_path)
+            return
+        except OSError as error:
+            if error.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+    shutil.rmtree(staging_path)
+
+def read_cache_meta(cache_path):
+    try:
+        with open(os.path.join(cache_path, "meta.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def read_cache(cache_path, max_branch_length=100000):
+    """Load a cached tree; the arrays are memory mapped, not read into memory."""
+    arrays = {name: np.load(os.path.join(cache_path, f"{name}.npy"), mmap_mode="r") for name in CACHE_ARRAYS}
+    with open(os.path.join(cache_path, "ids.txt")) as f:
+        ids = f.read().split("\n")
+    return FlatTree(
+        ids,
+        arrays["parent"],
+        arrays["child_offsets"],
+        arrays["children"],
+        arrays["mutation_node"],
+        arrays["mutation_code"],
+        arrays["branch_length"],
+        max_branch_length,
+        subtree_start=arrays["subtree_start"],
+    )
+
+def verify_cache(cache_path, digest, load=False):
+    """
+    Return a list of problems with the cache at cache_path, empty if it is
+    valid for digest. Only the metadata is checked unless load is set.
+    """
+    meta = read_cache_meta(cache_path)
+    if meta is None:
+        return [f"no readable cache at {cache_path}"]
+    problems = []
+    if meta.get("version") != CACHE_VERSION:
+        problems.append(f"cache version {meta.get('version')} != {CACHE_VERSION}")
+    if digest is not None and meta.get("sha256") != digest:
+        problems.append("cache was built from a different input tree")
+    if problems or not load:
+        return problems
+    try:
+        flat_tree = read_cache(cache_path)
+    except (OSError, ValueError) as error:
+        return [f"cache could not be loaded: {error}"]
+    if len(flat_tree) != meta["nodes"] or len(flat_tree.parent) != meta["nodes"]:
+        problems.append("node arrays do not match the recorded node count")
+    if len(flat_tree.mutation_node) != meta["mutations"]:
+        problems.append("mutation arrays do not match the recorded mutation count")
+    return problems
+
+def load_flat_tree(input_tree, tree_cache=None, max_branch_length=100000):
+    """
+    FlatTree for input_tree. With tree_cache None the protobuf is parsed as
+    before; otherwise the cache at tree_cache (or the default location when
+    it is an empty string) is used if it matches the input's content hash,
+    and is (re)built from the protobuf if not.
+    """
+    if tree_cache is None:
+        return FlatTree.from_bte(read_matree(input_tree), max_branch_length)
+
+    # without the input there is nothing to verify against, so trust an explicitly given cache
+    digest = content_hash(input_tree) if os.path.exists(input_tree) else None
+    if digest is None and not tree_cache:
+        raise FileNotFoundError(f"{input_tree} does not exist and no --tree_cache path was given")
+    cache_path = tree_cache or default_cache_path(input_tree, digest)
+    if not verify_cache(cache_path, digest):
+        print(f"Loading tree cache {cache_path}", file=sys.stderr)
+        return read_cache(cache_path, max_branch_length)
+
+    print(f"Building tree cache {cache_path}", file=sys.stderr)
+    flat_tree = FlatTree.from_bte(read_matree(input_tree), max_branch_length)
+    write_cache(flat_tree, cache_path, digest, input_tree)
+    return flat_tree
+
+class CachedNode:
+    """Read-only stand-in for a bte node backed by a FlatTree."""
+    __slots__ = ("flat_tree", "index")
+
+    def __init__(self, flat_tree, index):
+        self.flat_tree = flat_tree
+        self.index = index
+
+    @property
+    def id(self):
+        return self.flat_tree.ids[self.index]
+
+    @property
+    def children(self):
+        return [CachedNode(self.flat_tree, child) for child in self.flat_tree.node_children(self.index).tolist()]
+
+    @property
+    def mutations(self):
+        return self.flat_tree.node_mutations(self.index)
+
+    def is_leaf(self):
+        return bool(self.flat_tree.is_leaf[self.index])
+
+class CachedMATree:
+    """The read-only part of the bte.MATree interface, on top of a FlatTree."""
+
+    def __init__(self, flat_tree):
+        self.flat_tree = flat_tree
+
+    @property
+    def root(self):
+        return CachedNode(self.flat_tree, self.flat_tree.root)
+
+    def get_node(self, node_id):
+        return CachedNode(self.flat_tree, self.flat_tree.index[node_id])
+
+    def rsearch(self, node_id, include_self=False):
+        index = self.flat_tree.index[node_id]
+        ancestors = [CachedNode(self.flat_tree, index)] if include_self else []
+        index = int(self.flat_tree.parent[index])
+        while index >= 0:
+            ancestors.append(CachedNode(self.flat_tree, index))
+            index = int(self.flat_tree.parent[index])
+        return ancestors
+
+def load_matree(input_tree, tree_cache=None):
+    """bte.MATree for input_tree, or a read-only cached equivalent when tree_cache is given."""
+    if tree_cache is None:
+        return read_matree(input_tree)
+    return CachedMATree(load_flat_tree(input_tree, tree_cache))
+
+def main():
+    args = parse_args()
+    configure_metrics(args)
+    with metrics.phase("hash"):
+        digest = content_hash(args.input_tree)
+    cache_path = args.tree_cache or default_cache_path(args.input_tree, digest)
+    with metrics.phase("verify"):
+        problems = verify_cache(cache_path, digest, load=True)
+    if args.command == "verify":
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        print(f"{cache_path}: {'invalid' if problems else 'ok'}")
+        finish_metrics(args)
+        sys.exit(1 if problems else 0)
+    if problems:
+        with metrics.phase("build"):
+            load_flat_tree(args.input_tree, cache_path)
+    print(cache_path)
+    finish_metrics(args)
+
+if __name__ == "__main__":
+    main()
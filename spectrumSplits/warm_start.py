@@ -0,0 +1,167 @@
+import os
+import sys
+import csv
+import json
+import numpy as np
+
+### bump whenever the layout or meaning of the state changes
+STATE_VERSION = 1
+
+# The state of a finished run, kept to warm start the run on the next tree
+# release: the split node ids in postorder, the enclosing split of each, the
+# mutation type counts of every split region, and the region every tip fell
+# in. Internal node ids are not stable across releases, so splits are mapped
+# to the new tree through their tips, which are. The tip ids are stored as one
+# newline separated byte string, since a fixed-width string array of millions
+# of sample names would be many times larger.
+
+def write_state(path, flat_tree, spectra, settings):
+    """Write the state of a run from its final spectra (split node -> 12 counts)."""
+    stops = np.array(sorted(spectra), dtype=np.int64)
+    owner = flat_tree.region_owner(stops)
+    parents = np.asarray(flat_tree.parent)[stops]
+    split_parent = np.where(parents >= 0, owner[np.maximum(parents, 0)], -1)
+    tips = np.nonzero(flat_tree.is_leaf)[0]
+    directory, name = os.path.split(os.path.abspath(path))
+    staging_path = os.path.join(directory, f".{name}.tmp{os.getpid()}")
+    with open(staging_path, "wb") as f:
+        np.savez_compressed(
+            f,
+            version=STATE_VERSION,
+            settings=json.dumps(settings),
+            split_id=np.array([flat_tree.ids[stop] for stop in stops.tolist()], dtype=str),
+            split_parent=split_parent.astype(np.int32),
+            region_counts=np.array([spectra[stop] for stop in stops.tolist()], dtype=np.int64).reshape(len(stops), 12),
+            tip_ids=np.frombuffer("\n".join(flat_tree.ids[tip] for tip in tips.tolist()).encode(), dtype=np.uint8),
+            tip_region=owner[tips].astype(np.int32),
+        )
+    os.replace(staging_path, path)
+    print(f"State of {len(stops)} splits written to {path}", file=sys.stderr)
+
+def read_state(path, settings):
+    """
+    The state at path as a dict of arrays. Raises ValueError when it was
+    written by a run with other settings or another version.
+    """
+    with np.load(path) as data:
+        if int(data["version"]) != STATE_VERSION:
+            raise ValueError(f"state {path} has version {int(data['version'])}, expected {STATE_VERSION}")
+        state_settings = json.loads(str(data["settings"]))
+        if state_settings != settings:
+            changed = sorted(key for key in set(settings) | set(state_settings) if settings.get(key) != state_settings.get(key))
+            raise ValueError(f"state {path} was written by a run with different {', '.join(changed)}")
+        state = {name: data[name] for name in ("split_id", "split_parent", "region_counts", "tip_region")}
+        state["tip_ids"] = data["tip_ids"].tobytes().decode().split("\n")
+    return state
+
+def map_splits(flat_tree, state):
+    """
+    The node of the new tree every split of state maps to, or -1 when none
+    of its tips is left, whether the mapping is exact, and the node of every
+    old tip (-1 for the tips that are gone). A split maps to
+    the lowest common ancestor of its tips still in the tree; the mapping is
+    exact when that node has no other old tip below it, so new samples below
+    a split keep it exact but a rearranged clade does not.
+    """
+    nsplits = len(state["split_id"])
+    all_tips = np.array([flat_tree.index.get(tip_id, -1) for tip_id in state["tip_ids"]], dtype=np.int64)
+    survives = all_tips >= 0
+    tip_index, tip_region = all_tips[survives], state["tip_region"][survives]
+
+    # postorder range of each split's old tips: in a depth first order the lowest common ancestor of a set
+    # of nodes is that of its first and last one
+    first = np.full(nsplits, len(flat_tree), dtype=np.int64)
+    last = np.full(nsplits, -1, dtype=np.int64)
+    np.minimum.at(first, tip_region, tip_index)
+    np.maximum.at(last, tip_region, tip_index)
+    count = np.bincount(tip_region, minlength=nsplits)
+    # nested splits precede the splits around them, so one pass passes the ranges up
+    for k, parent in enumerate(state["split_parent"].tolist()):
+        if parent >= 0:
+            first[parent] = min(first[parent], first[k])
+            last[parent] = max(last[parent], last[k])
+            count[parent] += count[k]
+
+    # the lowest common ancestor is the first ancestor of the first tip that reaches past the last one
+    nodes = np.where(count > 0, first, -1)
+    climbing = np.nonzero((nodes >= 0) & (nodes < last))[0]
+    parent = np.asarray(flat_tree.parent)
+    while len(climbing):
+        nodes[climbing] = parent[nodes[climbing]]
+        climbing = climbing[nodes[climbing] < last[climbing]]
+    nodes[state["split_parent"] < 0] = flat_tree.root
+
+    old_tips = np.zeros(len(flat_tree) + 1, dtype=np.int64)
+    old_tips[tip_index + 1] = 1
+    np.cumsum(old_tips, out=old_tips)
+    mapped = nodes >= 0
+    below = np.zeros(nsplits, dtype=np.int64)
+    below[mapped] = old_tips[nodes[mapped] + 1] - old_tips[np.asarray(flat_tree.subtree_start)[nodes[mapped]]]
+    exact = mapped & (below == count)
+    exact[state["split_parent"] < 0] = True
+    return nodes, exact, all_tips
+
+def pair_moved_splits(flat_tree, state, tip_index, dropped, added, min_overlap=0.5):
+    """
+    Pairs (old split, new node) of dropped old splits and added new splits
+    whose old tips overlap by at least min_overlap (Jaccard), best first:
+    the same clade, found again where the new tree puts it.
+    """
+    survives = tip_index >= 0
+    tip_region = state["tip_region"][survives]
+    new_tips = np.sort(tip_index[survives])
+    split_parent = state["split_parent"].tolist()
+    overlaps = []
+    for k in dropped:
+        # the old regions nested in split k; parents come after their children
+        nested = np.zeros(len(split_parent), dtype=bool)
+        nested[k] = True
+        for r in reversed(range(k)):
+            nested[r] = split_parent[r] >= 0 and nested[split_parent[r]]
+        old_tips = np.sort(tip_index[survives][nested[tip_region]])
+        for node in added:
+            lo = flat_tree.subtree_start[node]
+            shared = np.searchsorted(old_tips, node, side="right") - np.searchsorted(old_tips, lo)
+            below = np.searchsorted(new_tips, node, side="right") - np.searchsorted(new_tips, lo)
+            union = len(old_tips) + below - shared
+            if union > 0 and shared / union >= min_overlap:
+                overlaps.append((shared / union, k, node))
+    pairs = {}
+    paired_nodes = set()
+    for overlap, k, node in sorted(overlaps, reverse=True):
+        if k not in pairs and node not in paired_nodes:
+            pairs[k] = node
+            paired_nodes.add(node)
+    return pairs
+
+def write_warm_report(path, flat_tree, state, carried, exact, change, tip_index, finalized):
+    """
+    One row per split of the previous run and per new split: kept (same
+    tips, still a split), moved (still a split, or found again nearby, but
+    its clade's old tips changed), dropped (gone, merged with another split
+    or no longer significant) or added. Returns the number of splits of
+    each status.
+    """
+    carried_from = {k: node for node, k in carried.items()}
+    dropped = [k for k in range(len(state["split_id"])) if carried_from.get(k) not in finalized]
+    added = sorted(set(finalized) - set(carried))
+    moved = pair_moved_splits(flat_tree, state, tip_index, dropped, added)
+    rows = []
+    for k, split_id in enumerate(state["split_id"].tolist()):
+        node = carried_from.get(k)
+        if k in moved:
+            node, status = moved[k], "moved"
+        elif node is not None and node in finalized:
+            status = "kept" if exact[k] else "moved"
+        else:
+            status = "dropped"
+        rows.append([split_id, flat_tree.ids[node] if node is not None else "", status, f"{change[node]:.6g}" if node in change else ""])
+    for node in added:
+        if node not in moved.values():
+            rows.append(["", flat_tree.ids[node], "added", ""])
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file, delimiter='\t')
+        writer.writerow(["Previous_Node_ID", "Node_ID", "Status", "Spectrum_Change"])
+        writer.writerows(rows)
+    statuses = [row[2] for row in rows]
+    return {status: statuses.count(status) for status in ("kept", "moved", "dropped", "added")}
@@ -0,0 +1,35 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+from bench_synthetic import parse_args, run_scale
+
+# The benchmark pipeline on a few synthetic trees: every stage runs, and the
+# planted shifts and artifact sites have to be found. The chi-square values
+# grow with the number of mutations, so the small tree gets lower thresholds.
+SCALES = [
+    pytest.param(5000, ["--min_chi", "100", "--mask_chi", "1000", "--min_total", "200"], id="5000"),
+    pytest.param(20000, [], id="20000"),
+    pytest.param(50000, [], id="50000"),
+    pytest.param(20000, ["--ladder", "0.9", "--tolerance", "10"], id="20000-deep"),
+]
+
+@pytest.fixture
+def run(request):
+    """Call a function once, timed by pytest-benchmark when it is installed."""
+    try:
+        benchmark = request.getfixturevalue("benchmark")
+    except pytest.FixtureLookupError:
+        return lambda function, *args: function(*args)
+    return lambda function, *args: benchmark.pedantic(function, args=args, rounds=1, iterations=1)
+
+@pytest.mark.parametrize("ntips, options", SCALES)
+def test_pipeline_finds_planted_splits(ntips, options, run, tmp_path, monkeypatch):
+    args = parse_args(["--ntips", str(ntips), "--bootstraps", "2"] + options)
+    # the bootstraps write their files to the working directory
+    monkeypatch.chdir(tmp_path)
+    rows, checks = run(run_scale, args, ntips, str(tmp_path))
+    assert [task for _, task, _ in rows] == ["generate_tree", "flatten", "find_splits", "bootstrap_splits", "bootstrap_spectra", "process_bootstraps", "mask_site_splits", "prune_mutation_sample_ratio"]
+    for check, passed, detail in checks:
+        assert passed, f"{check}: {detail}"
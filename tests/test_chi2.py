@@ -0,0 +1,99 @@
+import os
+import sys
+import numpy as np
+import pytest
+from scipy.stats import chi2_contingency
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "qc"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spectrumSplits"))
+from synthetic_tree import generate_tree, use_stand_in
+use_stand_in()
+from flat_tree import FlatTree
+from spectrumSplits import chi2_statistics, chi2_size_bounds, find_max_chi_node, compute_mutation_spectrum, get_stop_spectra
+from mask_site_splits import site_chi2_statistics
+
+# The vectorized statistics claim to reproduce scipy.stats.chi2_contingency
+# exactly, so these compare with == rather than a tolerance.
+
+def test_chi2_statistics_matches_scipy():
+    rng = np.random.default_rng(1)
+    node_spectra = rng.integers(1, 500, size=(200, 12))
+    above_spectra = rng.integers(1, 5000, size=(200, 12))
+    # a small block size also covers the blocking
+    chi = chi2_statistics(node_spectra, above_spectra, block_size=64)
+    for k in range(len(node_spectra)):
+        assert chi[k] == chi2_contingency(np.array([node_spectra[k], above_spectra[k]]))[0]
+
+def test_chi2_statistics_zero_column_raises_like_scipy():
+    node_spectra = np.ones((3, 12), dtype=np.int64)
+    above_spectra = np.ones((3, 12), dtype=np.int64)
+    node_spectra[1, 4] = above_spectra[1, 4] = 0
+    with pytest.raises(ValueError) as expected:
+        chi2_contingency(np.array([node_spectra[1], above_spectra[1]]))
+    with pytest.raises(ValueError) as raised:
+        chi2_statistics(node_spectra, above_spectra)
+    # scipy formats the position with numpy scalars, so only the message before it is compared
+    assert str(raised.value).split(" at ")[0] == str(expected.value).split(" at ")[0]
+    assert str(raised.value).endswith("(0, 4).")
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_chi2_size_bounds_cover_the_statistic(seed):
+    rng = np.random.default_rng(seed)
+    # one mutation type much rarer than the others, so small nodes get bounds below N
+    split_root_spectrum = rng.integers(50, 5000, size=12)
+    split_root_spectrum[rng.integers(12)] = rng.integers(1, 50)
+    node_spectra = np.array([rng.binomial(split_root_spectrum, p) for p in rng.uniform(0, 1, size=500) ** 3])
+    # and the extreme case the bound is built on: every mutation of the node of the rarest type
+    rarest = np.zeros((split_root_spectrum.min(), 12), dtype=np.int64)
+    rarest[:, split_root_spectrum.argmin()] = np.arange(1, split_root_spectrum.min() + 1)
+    node_spectra = np.concatenate([node_spectra, rarest])
+    node_spectra = node_spectra[(node_spectra.sum(axis=1) > 0) & (node_spectra.sum(axis=1) < split_root_spectrum.sum())]
+    chi = chi2_statistics(node_spectra, split_root_spectrum - node_spectra)
+    bounds = chi2_size_bounds(node_spectra.sum(axis=1), split_root_spectrum)
+    assert np.all(chi <= bounds)
+    assert np.any(bounds < split_root_spectrum.sum())
+
+def per_node_max_chi(nodes, spectra, min_mutations):
+    """find_max_chi_node the slow way: every eligible node through chi2_contingency, ties to the first."""
+    root = spectra[-1]
+    best_chi, best_node = 0, None
+    for node, spectrum in zip(nodes.tolist(), spectra):
+        if spectrum.sum() < min_mutations or root.sum() - spectrum.sum() < min_mutations:
+            continue
+        chi = chi2_contingency(np.array([spectrum, root - spectrum]))[0]
+        if chi > best_chi:
+            best_chi, best_node = chi, node
+    return best_chi, best_node
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+@pytest.mark.parametrize("min_mutations", [20, 200])
+def test_find_max_chi_node_matches_per_node_loop(seed, min_mutations):
+    flat_tree = FlatTree.from_bte(generate_tree(3000, nshifts=3, min_clade=0.02, max_clade=0.1, seed=seed))
+    subtree_spectra = flat_tree.subtree_spectra(flat_tree.counts)
+    no_stops = (np.empty(0, dtype=np.int64), np.empty((0, 12), dtype=np.int64))
+    regions = [compute_mutation_spectrum(flat_tree, flat_tree.root, *no_stops, subtree_spectra)]
+    # and a region with nested splits carved out, as in later iterations of find_splits
+    internal = np.nonzero(~np.asarray(flat_tree.is_leaf))[0]
+    stops, stop_spectra = get_stop_spectra(flat_tree, set(internal[-40:-1:7].tolist()) | {flat_tree.root}, subtree_spectra)
+    regions.append(compute_mutation_spectrum(flat_tree, flat_tree.root, stops, stop_spectra, subtree_spectra))
+    for nodes, spectra in regions:
+        assert find_max_chi_node(nodes, spectra, min_mutations) == per_node_max_chi(nodes, spectra, min_mutations)
+
+def test_site_chi2_statistics_matches_scipy():
+    rng = np.random.default_rng(2)
+    total_above = rng.integers(1, 10000, size=300)
+    snps_above = rng.integers(0, 50, size=300)
+    total_below = rng.integers(1, 2000, size=300)
+    snps_below = rng.integers(0, 50, size=300)
+    chi = site_chi2_statistics(total_above, snps_above, total_below, snps_below)
+    for k in range(len(chi)):
+        table = np.array([[total_above[k], snps_above[k]], [total_below[k], snps_below[k]]])
+        if np.all(table.sum(axis=0) > 0):
+            assert chi[k] == chi2_contingency(table)[0]
+
+def test_site_chi2_statistics_zero_expected_scores_zero():
+    # chi2_contingency rejects a table with an empty column; the scan scores it 0 instead
+    with pytest.raises(ValueError):
+        chi2_contingency(np.array([[10, 0], [20, 0]]))
+    assert site_chi2_statistics(np.array([10]), np.array([0]), np.array([20]), np.array([0]))[0] == 0
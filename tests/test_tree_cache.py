@@ -0,0 +1,42 @@
+import os
+import sys
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spectrumSplits"))
+from synthetic_tree import generate_tree, use_stand_in
+use_stand_in()
+from flat_tree import FlatTree
+from tree_cache import write_cache, read_cache, verify_cache
+
+def small_tree(seed):
+    return FlatTree.from_bte(generate_tree(200, nshifts=0, seed=seed))
+
+def test_stale_cache_is_replaced(tmp_path):
+    cache_path = str(tmp_path / "tree.cache")
+    write_cache(small_tree(1), cache_path, "old", "tree.pb")
+    write_cache(small_tree(2), cache_path, "new", "tree.pb")
+    assert verify_cache(cache_path, "new", load=True) == []
+    assert read_cache(cache_path).ids == small_tree(2).ids
+    assert os.listdir(tmp_path) == ["tree.cache"]
+
+def test_valid_cache_is_kept(tmp_path):
+    cache_path = str(tmp_path / "tree.cache")
+    write_cache(small_tree(1), cache_path, "same", "tree.pb")
+    inode = os.stat(cache_path).st_ino
+    write_cache(small_tree(2), cache_path, "same", "tree.pb")
+    # readers may have the first copy mapped, so it stays in place
+    assert os.stat(cache_path).st_ino == inode
+    assert read_cache(cache_path).ids == small_tree(1).ids
+    assert os.listdir(tmp_path) == ["tree.cache"]
+
+def write_in_worker(cache_path):
+    write_cache(small_tree(3), cache_path, "new", "tree.pb")
+
+def test_concurrent_writers(tmp_path):
+    cache_path = str(tmp_path / "tree.cache")
+    write_cache(small_tree(1), cache_path, "old", "tree.pb")
+    with Pool(8) as pool:
+        pool.map(write_in_worker, [cache_path] * 32)
+    assert verify_cache(cache_path, "new", load=True) == []
+    assert os.listdir(tmp_path) == ["tree.cache"]